@@ -0,0 +1,104 @@
+"""Memory used per cached thread message, for the old and current representations.
+
+Run with `python bench/message_memory.py` from the repository root."""
+
+import gc
+import importlib.util
+from pathlib import Path
+import random
+import string
+import tracemalloc
+
+MESSAGES = 10_000
+COMPRESS_MIN_BYTES = 512
+
+# Load the message module directly, the chat_thread package reads config.yaml on import
+spec = importlib.util.spec_from_file_location(
+    "message", Path(__file__).parent.parent / "synthbot" / "chat_thread" / "message.py"
+)
+message = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(message)
+
+
+class LegacyMessage:
+    """How messages were kept before: a plain object with a token count dict and a reference to the channel."""
+
+    def __init__(self, author_id, channel, message_id, message_text):
+        self.author_id = author_id
+        self.thread_id = channel
+        self.message_id = message_id
+        self.message_text = message_text
+        self.token_counts = {}
+
+
+def make_texts() -> list[str]:
+    rng = random.Random(1)
+    words = [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9)))
+        for _ in range(2000)
+    ]
+    return [
+        " ".join(rng.choices(words, k=rng.choice([8, 30, 60, 200])))
+        for _ in range(MESSAGES)
+    ]
+
+
+def measure(build) -> tuple[list, int]:
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = build()
+    gc.collect()
+    return messages, tracemalloc.get_traced_memory()[0] - before
+
+
+def main():
+    texts = make_texts()
+    channel = object()
+    average_text = sum(len(text) for text in texts) / len(texts)
+    tracemalloc.start()
+
+    def build_legacy():
+        messages = []
+        for i, text in enumerate(texts):
+            # Copy the text so it's counted as part of the message
+            msg = LegacyMessage(
+                10**18 + i % 7, channel, 12 * 10**17 + i, text.encode().decode()
+            )
+            msg.token_counts["gpt-4o"] = len(text) // 4
+            messages.append(msg)
+        return messages
+
+    def build_current():
+        messages = []
+        for i, text in enumerate(texts):
+            msg = message.ChatThreadConversationMessage.from_record(
+                10**18 + i % 7, 11 * 10**17, 12 * 10**17 + i, text.encode().decode()
+            )
+            msg.set_token_count("gpt-4o", len(text) // 4)
+            messages.append(msg)
+        return messages
+
+    legacy, legacy_bytes = measure(build_legacy)
+    del legacy
+    current, current_bytes = measure(build_current)
+
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    for msg in current:
+        msg.compress(COMPRESS_MIN_BYTES)
+    gc.collect()
+    compressed_bytes = current_bytes + tracemalloc.get_traced_memory()[0] - before
+
+    print(f"{MESSAGES} messages, {average_text:.0f} characters of text on average")
+    for name, used in [
+        ("legacy", legacy_bytes),
+        ("slotted", current_bytes),
+        (f"slotted, compressing {COMPRESS_MIN_BYTES}B+", compressed_bytes),
+    ]:
+        print(
+            f"{name:>30}: {used / MESSAGES:7.1f} B/message, {used / 2**20:6.2f} MiB total"
+        )
+
+
+if __name__ == "__main__":
+    main()
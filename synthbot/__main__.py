@@ -1,26 +1,50 @@
 import logging
 import logging.handlers
+import queue
 import sys
 
-from .config import bot_config
-from .discord_bot import client
+from .startup import startup_stage
 
+with startup_stage("config"):
+    from .config import bot_config
+with startup_stage("client"):
+    from .discord_bot import client
+from .logs import DeferredQueueHandler, JsonFormatter, SamplingFilter, TextFormatter
 
-def setup_logger():
+
+def setup_logger() -> logging.handlers.QueueListener:
+    """Send log records through a queue, so formatting and writing them happens on a background thread."""
     logger = logging.getLogger()
-    formatter = logging.Formatter(
-        "[{asctime}] [{levelname:<8}] {name}: {message}", "%Y-%m-%d %H:%M:%S", style="{"
-    )
+    if bot_config.bot.log_json:
+        formatter = JsonFormatter(bot_config.bot.log_max_length)
+    else:
+        formatter = TextFormatter(
+            "[{asctime}] [{levelname:<8}] {name}: {message}",
+            "%Y-%m-%d %H:%M:%S",
+            bot_config.bot.log_max_length,
+        )
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(bot_config.bot.log_sample_rates))
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
 
     if "--debug" in sys.argv or bot_config.bot.debug:
         for key in logging.Logger.manager.loggerDict:
             if key.startswith("synthbot"):
                 logging.getLogger(key).setLevel(logging.DEBUG)
 
+    return listener
+
 
-setup_logger()
+log_listener = setup_logger()
 
-client.run(bot_config.discord.token, log_handler=None)
+try:
+    client.run(bot_config.discord.token, log_handler=None)
+finally:
+    # Write out whatever is still queued
+    log_listener.stop()
@@ -0,0 +1,202 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Returned by TTLCache.get when there's no usable entry, since None is a valid cached value
+MISSING = object()
+
+
+class SqliteWorker(ABC):
+    """A SQLite database that's only touched from a single worker thread, so the event loop never waits on
+    disk. Subclasses create their tables and run their queries on the worker."""
+
+    # What this is called in failure logs
+    description = "SQLite store"
+
+    def __init__(self, path: str, thread_name: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=thread_name
+        )
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if not self._conn:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._create_tables(self._conn)
+        return self._conn
+
+    @abstractmethod
+    def _create_tables(self, conn: sqlite3.Connection):
+        """Create or migrate the tables, on first use."""
+
+    async def _call(self, fn, *args):
+        """Run fn on the worker and wait for its result."""
+        return await asyncio.wrap_future(self._executor.submit(fn, *args))
+
+    def _submit(self, fn, *args):
+        """Run fn on the worker without waiting, logging if it fails."""
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._log_failure)
+
+    def _log_failure(self, future):
+        if not future.cancelled() and future.exception():
+            logger.error(
+                "Failed to write to %s %s",
+                self.description,
+                self.path,
+                exc_info=future.exception(),
+            )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+class SqliteStore(SqliteWorker):
+    """A key/value table in SQLite, used to keep a cache warm across restarts."""
+
+    description = "cache store"
+
+    def __init__(
+        self,
+        path: str,
+        table: str,
+        serialize: Callable[[Any], Any] = lambda v: v,
+        deserialize: Callable[[Any], Any] = lambda v: v,
+    ):
+        super().__init__(path, f"sqlite-{table}")
+        self.table = table
+        self.serialize = serialize
+        self.deserialize = deserialize
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT, expires REAL)"
+        )
+
+    def _load(self, limit: int) -> list[tuple[str, Any, float]]:
+        self.conn.execute(
+            f"DELETE FROM {self.table} WHERE expires <= ?", (time.time(),)
+        )
+        self.conn.commit()
+        rows = self.conn.execute(
+            f"SELECT key, value, expires FROM {self.table} ORDER BY expires DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        return [
+            (key, self.deserialize(json.loads(value)), expires)
+            for key, value, expires in rows
+        ]
+
+    def _put(self, key: str, value: Any, expires: float):
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, expires) VALUES (?, ?, ?)",
+            (key, json.dumps(self.serialize(value)), expires),
+        )
+        self.conn.commit()
+
+    def _delete(self, key: str):
+        self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        self.conn.commit()
+
+    async def load(self, limit: int) -> list[tuple[str, Any, float]]:
+        """Get up to limit unexpired entries, newest first."""
+        return await self._call(self._load, limit)
+
+    def put(self, key: str, value: Any, expires: float):
+        self._submit(self._put, key, value, expires)
+
+    def delete(self, key: str):
+        self._submit(self._delete, key)
+
+
+class TTLCache:
+    """A size-bounded LRU cache where every entry expires, optionally written through to a SqliteStore."""
+
+    # key -> (value, expiry time)
+    _entries: OrderedDict[str, tuple[Any, float]]
+
+    def __init__(self, max_size: int, ttl: float, store: Optional[SqliteStore] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Any:
+        """Get a cached value, or MISSING if it isn't cached or has expired."""
+        entry = self._entries.get(key)
+        if entry and entry[1] <= time.time():
+            # Expired
+            del self._entries[key]
+            self.expirations += 1
+            entry = None
+
+        if not entry:
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        self._set(key, value, expires)
+        if self.store:
+            self.store.put(key, value, expires)
+
+    def _set(self, key: str, value: Any, expires: float):
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            evicted, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            if self.store:
+                self.store.delete(evicted)
+
+    def delete(self, key: str):
+        if self._entries.pop(key, None) and self.store:
+            self.store.delete(key)
+
+    async def load(self):
+        """Warm the cache from its store."""
+        if not self.store:
+            return
+
+        entries = await self.store.load(self.max_size)
+        # Oldest first so the newest entries end up most recently used
+        for key, value, expires in reversed(entries):
+            self._set(key, value, expires)
+        logger.info("Loaded %d cache entries from %s", len(entries), self.store.path)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
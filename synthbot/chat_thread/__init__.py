@@ -1 +1,2 @@
 from .manager import ChatThreadManager
+from .thread import ChatThread
@@ -1,23 +1,116 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import discord
 import logging
+from typing import AsyncIterator
 
+from ..config import bot_config
+from ..metrics import reply_stage_seconds
 from .thread import ChatThread
 
 logger = logging.getLogger(__name__)
 
 
 class ChatThreadManager:
-    threads: dict[int, ChatThread]
+    # Least recently used first
+    threads: OrderedDict[int, ChatThread]
+    # Threads currently being loaded, so concurrent callers share one load
+    _loading: dict[int, asyncio.Task[ChatThread]]
 
     def __init__(self):
-        self.threads = {}
+        self.threads = OrderedDict()
+        self._loading = {}
+        self.max_threads = bot_config.threads.max_cached_threads
+        self.max_bytes = bot_config.threads.max_cached_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     async def get_thread(self, bot_user: discord.ClientUser, thread: discord.Thread):
         thread_id = thread.id
         if thread_id in self.threads:
+            self.hits += 1
+            self.threads.move_to_end(thread_id)
             return self.threads[thread_id]
 
+        task = self._loading.get(thread_id)
+        if not task:
+            self.misses += 1
+            task = asyncio.create_task(self._load_thread(bot_user, thread))
+            self._loading[thread_id] = task
+            task.add_done_callback(lambda _: self._loading.pop(thread_id, None))
+
+        # Shielded so one caller giving up doesn't cancel the load for everyone else
+        return await asyncio.shield(task)
+
+    async def _load_thread(self, bot_user: discord.ClientUser, thread: discord.Thread):
         ct = ChatThread(bot_user, thread)
-        await ct.load()
-        self.threads[thread_id] = ct
+        with reply_stage_seconds.time("thread_load"):
+            await ct.load()
+        self.threads[thread.id] = ct
         return ct
+
+    def add_new_thread(
+        self,
+        bot_user: discord.ClientUser,
+        thread: discord.Thread,
+        message: discord.Message,
+    ) -> ChatThread:
+        """Register a thread we just created from a message, so its first reply doesn't load it from Discord."""
+        ct = ChatThread.from_new_thread(bot_user, thread, message)
+        self.threads[thread.id] = ct
+        return ct
+
+    @asynccontextmanager
+    async def use_thread(
+        self, bot_user: discord.ClientUser, thread: discord.Thread
+    ) -> AsyncIterator[ChatThread]:
+        """Get a thread and hold it for one reply.
+
+        Replies in the same thread take turns in the order they arrived, and the thread can't be evicted while
+        anyone is using or waiting for it."""
+        ct = await self.get_thread(bot_user, thread)
+        ct.active += 1
+        try:
+            async with ct.lock:
+                yield ct
+        finally:
+            ct.active -= 1
+            self.evict()
+
+    @property
+    def cached_bytes(self) -> int:
+        return sum(ct.size_bytes for ct in self.threads.values())
+
+    def evict(self):
+        """Drop least recently used idle threads until we're under the cache limits.
+
+        Evicted threads are loaded from Discord again the next time they're used."""
+        cached_bytes = self.cached_bytes
+
+        for thread_id in list(self.threads.keys()):
+            if len(self.threads) <= self.max_threads and cached_bytes <= self.max_bytes:
+                break
+
+            ct = self.threads[thread_id]
+            if ct.active:
+                continue
+
+            del self.threads[thread_id]
+            cached_bytes -= ct.size_bytes
+            self.evictions += 1
+            logger.debug("Evicted thread %s from the cache", thread_id)
+
+    @property
+    def stats(self) -> dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            "threads": len(self.threads),
+            "cached_bytes": self.cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "evictions": self.evictions,
+        }
@@ -1,29 +1,118 @@
 from abc import ABC
 import discord
 import logging
+from typing import Optional
+import zlib
 
 logger = logging.getLogger(__name__)
 
 
 class ChatThreadMessage(ABC):
+    """A parsed thread message, keeping only IDs and text so it doesn't hold on to any Discord objects.
+
+    Threads can cache thousands of these, so they're slotted and keep their token count inline for the model
+    that's usually asked for. Text that's no longer sent to OpenAI can be compressed in place.
+    """
+
+    __slots__ = (
+        "author_id",
+        "thread_id",
+        "message_id",
+        "_text",
+        "_token_model",
+        "_token_count",
+        "_other_token_counts",
+    )
+
     author_id: int
     thread_id: int
     message_id: int
-    message_text: str
+    # The message text, or its zlib compressed UTF-8 once compressed
+    _text: str | bytes
+    _token_model: Optional[str]
+    _token_count: int
+    # model -> number of tokens, for models other than _token_model
+    _other_token_counts: Optional[dict[str, int]]
 
     def __init__(
         self, message: discord.Message, full_text: str = None, strip_mention: str = None
     ):
-        self.author_id = message.author.id
-        self.thread_id = message.channel
-        self.message_id = message.id
-
         if full_text:
-            self.message_text = full_text
+            message_text = full_text
         elif strip_mention:
-            self.message_text = message.content.replace(strip_mention, "").strip()
+            message_text = message.content.replace(strip_mention, "").strip()
+        else:
+            message_text = message.clean_content
+
+        self._set(message.author.id, message.channel.id, message.id, message_text)
+
+    @classmethod
+    def from_record(
+        cls, author_id: int, thread_id: int, message_id: int, message_text: str
+    ):
+        """Recreate a message that was already parsed from Discord."""
+        msg = cls.__new__(cls)
+        msg._set(author_id, thread_id, message_id, message_text)
+        return msg
+
+    def _set(self, author_id: int, thread_id: int, message_id: int, message_text: str):
+        self.author_id = author_id
+        self.thread_id = thread_id
+        self.message_id = message_id
+        self._text = message_text
+        self._token_model = None
+        self._token_count = 0
+        self._other_token_counts = None
+
+    @property
+    def message_text(self) -> str:
+        if isinstance(self._text, bytes):
+            return zlib.decompress(self._text).decode()
+        return self._text
+
+    @property
+    def size_bytes(self) -> int:
+        """Size of the text as stored."""
+        return (
+            len(self._text)
+            if isinstance(self._text, bytes)
+            else len(self._text.encode())
+        )
+
+    def compress(self, min_bytes: int) -> int:
+        """Compress the text if it's at least min_bytes and compressing makes it smaller.
+
+        Returns how many bytes were saved."""
+        if isinstance(self._text, bytes):
+            return 0
+
+        encoded = self._text.encode()
+        if len(encoded) < min_bytes:
+            return 0
+
+        compressed = zlib.compress(encoded)
+        if len(compressed) >= len(encoded):
+            return 0
+
+        self._text = compressed
+        return len(encoded) - len(compressed)
+
+    def token_count(self, model: str) -> Optional[int]:
+        """Number of tokens this message uses in a conversation with this model, if it's been counted."""
+        if model == self._token_model:
+            return self._token_count
+        if self._other_token_counts:
+            return self._other_token_counts.get(model)
+        return None
+
+    def set_token_count(self, model: str, count: int):
+        if self._token_model is None or model == self._token_model:
+            self._token_model = model
+            self._token_count = count
         else:
-            self.message_text = message.clean_content
+            if self._other_token_counts is None:
+                self._other_token_counts = {}
+            self._other_token_counts[model] = count
 
     def to_conversation(self, bot_user: discord.ClientUser) -> dict[str, str] | None:
         """Get the conversation component of this message."""
@@ -31,12 +120,15 @@ class ChatThreadMessage(ABC):
 
 
 class ChatThreadConversationMessage(ChatThreadMessage):
+    __slots__ = ()
+
     def to_conversation(self, bot_user: discord.ClientUser):
-        if self.message_text.startswith("---\n"):
+        message_text = self.message_text
+        if message_text.startswith("---\n"):
             return None
 
-        role = "assistant" if self.author_id is bot_user.id else "user"
-        return {"role": role, "content": self.message_text}
+        role = "assistant" if self.author_id == bot_user.id else "user"
+        return {"role": role, "content": message_text}
 
 
 def parse_discord_message(
@@ -44,6 +136,7 @@ def parse_discord_message(
 ):
     """Parse a Discord message into the approperate ChatThreadMessage type."""
     thread_name = message.channel.name
+    log_context = {"thread_id": message.channel.id, "message_id": message.id}
 
     if message.type not in [
         discord.MessageType.thread_starter_message,
@@ -53,9 +146,11 @@ def parse_discord_message(
         # Ignore other message types (thread renames, etc)
         logger.debug(
             "Ignored thread event [name: %s, type: %s, author: %s]: %s",
+            thread_name,
             message.type,
             message.author,
             message.system_content,
+            extra=log_context,
         )
         return None
     elif (
@@ -71,6 +166,7 @@ def parse_discord_message(
             message.type,
             message.author,
             message.system_content,
+            extra=log_context,
         )
         return ChatThreadConversationMessage(
             message.reference.resolved,
@@ -85,6 +181,7 @@ def parse_discord_message(
             message.type,
             message.author,
             message.content,
+            extra=log_context,
         )
         return None
     elif message.author == bot_user:
@@ -95,6 +192,7 @@ def parse_discord_message(
             message.type,
             message.author,
             message.content,
+            extra=log_context,
         )
         return ChatThreadConversationMessage(message, full_text=full_text)
     elif message.author.bot:
@@ -105,6 +203,7 @@ def parse_discord_message(
             message.type,
             message.author,
             message.content,
+            extra=log_context,
         )
         # Ignore other bot's messages
         return None
@@ -116,5 +215,6 @@ def parse_discord_message(
             message.type,
             message.author,
             message.content,
+            extra=log_context,
         )
         return ChatThreadConversationMessage(message, full_text=full_text)
@@ -0,0 +1,130 @@
+import sqlite3
+from typing import TYPE_CHECKING, Optional
+
+from ..cache import SqliteWorker
+from ..config import bot_config
+from .message import ChatThreadConversationMessage, ChatThreadMessage
+
+if TYPE_CHECKING:
+    from .thread import ChatThread
+
+THREAD_COLUMNS = {
+    "compacted_summary": "TEXT",
+    "compacted_upto": "INTEGER",
+    "stored_from": "INTEGER",
+}
+
+
+class ConversationStore(SqliteWorker):
+    """Keeps parsed thread messages, summaries and compacted summaries in SQLite so threads don't have to
+    replay their Discord history after a restart."""
+
+    description = "conversation store"
+
+    def __init__(self, path: str):
+        super().__init__(path, "conversation-store")
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS messages (
+                thread_id INTEGER,
+                message_id INTEGER,
+                author_id INTEGER,
+                message_text TEXT,
+                PRIMARY KEY (thread_id, message_id)
+            )"""
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS threads (thread_id INTEGER PRIMARY KEY, summary TEXT)"
+        )
+
+        # Columns added after the table was first created
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(threads)")}
+        for column, column_type in THREAD_COLUMNS.items():
+            if column not in columns:
+                conn.execute(f"ALTER TABLE threads ADD COLUMN {column} {column_type}")
+
+    def _load_messages(
+        self, thread_id: int, after_id: int
+    ) -> list[tuple[int, int, str]]:
+        return self.conn.execute(
+            "SELECT message_id, author_id, message_text FROM messages WHERE thread_id = ? AND message_id > ? ORDER BY message_id",
+            (thread_id, after_id),
+        ).fetchall()
+
+    def _load_thread(
+        self, thread_id: int
+    ) -> tuple[Optional[str], Optional[str], Optional[int], Optional[int]]:
+        row = self.conn.execute(
+            "SELECT summary, compacted_summary, compacted_upto, stored_from FROM threads WHERE thread_id = ?",
+            (thread_id,),
+        ).fetchone()
+        return row if row else (None, None, None, None)
+
+    def _save_message(
+        self, thread_id: int, message_id: int, author_id: int, message_text: str
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO messages (thread_id, message_id, author_id, message_text) VALUES (?, ?, ?, ?)",
+            (thread_id, message_id, author_id, message_text),
+        )
+        self.conn.commit()
+
+    def _save_thread(
+        self,
+        thread_id: int,
+        summary: Optional[str],
+        compacted_summary: Optional[str],
+        compacted_upto: Optional[int],
+        stored_from: Optional[int],
+    ):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO threads (thread_id, summary, compacted_summary, compacted_upto, stored_from) VALUES (?, ?, ?, ?, ?)",
+            (thread_id, summary, compacted_summary, compacted_upto, stored_from),
+        )
+        self.conn.commit()
+
+    async def load_messages(
+        self, thread_id: int, after_id: Optional[int] = None
+    ) -> list[ChatThreadMessage]:
+        """Get the stored messages for a thread newer than after_id, oldest first."""
+        rows = await self._call(self._load_messages, thread_id, after_id or 0)
+        return [
+            ChatThreadConversationMessage.from_record(
+                author_id, thread_id, message_id, message_text
+            )
+            for message_id, author_id, message_text in rows
+        ]
+
+    async def load_thread(
+        self, thread_id: int
+    ) -> tuple[Optional[str], Optional[str], Optional[int], Optional[int]]:
+        """Get a thread's summary, compacted summary, the newest message ID in the compacted summary and the
+        oldest message ID its stored messages are complete from, if they have a gap."""
+        return await self._call(self._load_thread, thread_id)
+
+    def save_message(self, thread_id: int, message: ChatThreadMessage):
+        self._submit(
+            self._save_message,
+            thread_id,
+            message.message_id,
+            message.author_id,
+            message.message_text,
+        )
+
+    def save_thread(self, thread: "ChatThread"):
+        self._submit(
+            self._save_thread,
+            thread.thread.id,
+            thread.summary,
+            thread.compacted_summary,
+            thread.compacted_upto,
+            thread.stored_from,
+        )
+
+
+conversation_store = (
+    ConversationStore(bot_config.threads.store_path)
+    if bot_config.threads.store_path
+    else None
+)
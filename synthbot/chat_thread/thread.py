@@ -1,28 +1,97 @@
+import asyncio
 import discord
+from itertools import islice
 import logging
-from typing import Generator, Iterable
+from typing import AsyncIterator, Optional
 
 from ..config import bot_config
-from ..gpt import GptConversation
-from .message import ChatThreadMessage, parse_discord_message
+from ..gpt import GptConversation, model_router
+from ..metrics import reply_stage_seconds
+from ..scheduler import PRIORITY_SUMMARY
+from ..usage import RequestScope
+from .message import (
+    ChatThreadConversationMessage,
+    ChatThreadMessage,
+    parse_discord_message,
+)
+from .store import conversation_store
+from .window import TokenWindow
 
 logger = logging.getLogger(__name__)
 
+# Messages per Discord history request, which is the most it allows
+HISTORY_PAGE_SIZE = 100
+
 
 # The idea here is to have an abstracted 'thread' that holds some state of a conversation
 
 
 class ChatThread:
-    messages: list[ChatThreadMessage]
+    window: TokenWindow
     bot_user: discord.ClientUser
     thread: discord.Thread
     summary: str
+    # Number of replies using or waiting for this thread
+    active: int
+    # Held while producing a reply so replies come out in order
+    lock: asyncio.Lock
+    _summary_task: Optional[asyncio.Task[str]]
+    # Running summary of the messages that were compacted out of the window
+    compacted_summary: Optional[str]
+    # Newest message ID included in the compacted summary
+    compacted_upto: Optional[int]
+    # Oldest message ID the stored messages are complete from, when older ones were skipped and not fetched since
+    stored_from: Optional[int]
+    _compaction_task: Optional[asyncio.Task[None]]
+    # (model, reply text, completion tokens) OpenAI reported for our last reply, used instead of counting it again
+    _reply_usage: Optional[tuple[str, str, int]]
+    # Whether there's no older Discord history left to load
+    _history_complete: bool
+    # Oldest Discord message ID we've fetched, whether or not it was kept
+    _oldest_fetched_id: Optional[int]
 
     def __init__(self, bot_user: discord.ClientUser, thread: discord.Thread):
-        self.messages = []
+        self.window = TokenWindow()
         self.bot_user = bot_user
         self.thread = thread
         self.summary = None
+        self.active = 0
+        self.lock = asyncio.Lock()
+        self._summary_task = None
+        self.compacted_summary = None
+        self.compacted_upto = None
+        self.stored_from = None
+        self._compaction_task = None
+        self._reply_usage = None
+        self._history_complete = False
+        self._oldest_fetched_id = None
+
+    @classmethod
+    def from_new_thread(
+        cls,
+        bot_user: discord.ClientUser,
+        thread: discord.Thread,
+        message: discord.Message,
+    ) -> "ChatThread":
+        """Start a thread we just created from the message that mentioned us, without fetching its history."""
+        ct = cls(bot_user, thread)
+        # The same message Discord would give us as the thread starter
+        parsed = ChatThreadConversationMessage(message, strip_mention=bot_user.mention)
+        ct.window.append(parsed)
+        if conversation_store:
+            conversation_store.save_message(thread.id, parsed)
+
+        # Nothing else can be in a thread this new
+        ct._history_complete = True
+        return ct
+
+    @property
+    def messages(self):
+        return self.window.messages
+
+    @property
+    def size_bytes(self):
+        return self.window.text_bytes
 
     @property
     def system_message(self):
@@ -30,32 +99,198 @@ class ChatThread:
 
     @property
     def system_message_continuation(self):
-        return f'You are continuing a conversation in a thread called "{self.summary}". Keep your replies under 1800 characters. Markdown is allowed.'
+        # Sent after system_message, which stays the same so OpenAI can cache the start of the prompt
+        message = (
+            f'You are continuing a conversation in a thread called "{self.summary}".'
+        )
+        if self.compacted_summary:
+            message += (
+                f"\n\nSummary of the earlier conversation:\n{self.compacted_summary}"
+            )
+        return message
+
+    @property
+    def scope(self) -> RequestScope:
+        return RequestScope(
+            self.thread.id, self.thread.guild.id if self.thread.guild else None
+        )
+
+    def _parse(
+        self, message: discord.Message, full_text: str = None
+    ) -> Optional[ChatThreadMessage]:
+        if message.id in self.window.message_ids:
+            # Already loaded from the thread history
+            return None
+
+        parsed = parse_discord_message(message, self.bot_user, full_text=full_text)
+        if parsed and conversation_store:
+            conversation_store.save_message(self.thread.id, parsed)
+        return parsed
 
     def add(
         self,
         message: discord.Message,
         full_text: str = None,
     ):
-        parsed = parse_discord_message(message, self.bot_user, full_text=full_text)
+        parsed = self._parse(message, full_text=full_text)
         if parsed:
-            self.messages.append(parsed)
+            if self._reply_usage and parsed.author_id == self.bot_user.id:
+                model, text, completion_tokens = self._reply_usage
+                if parsed.message_text == text:
+                    # OpenAI already told us how long our reply is, plus the role and message framing
+                    parsed.set_token_count(model, completion_tokens + 4)
+                self._reply_usage = None
+            self.window.append(parsed)
 
     async def load(self):
-        """Load messages from Discord to the thread."""
-        async for message in self.thread.history(limit=100, oldest_first=True):
-            self.add(message)
+        """Load the thread's stored messages and its newest Discord messages.
+
+        Older history is only fetched once a prompt needs it, see load_older."""
+        if conversation_store:
+            # Start from what we've already seen and only fetch newer messages
+            (
+                self.summary,
+                self.compacted_summary,
+                self.compacted_upto,
+                self.stored_from,
+            ) = await conversation_store.load_thread(self.thread.id)
+            if (
+                self.stored_from
+                and self.compacted_upto
+                and self.stored_from <= self.compacted_upto
+            ):
+                # Compaction has caught up past the gap
+                self.stored_from = None
+
+            # Stored messages before a gap would splice unrelated turns into the prompt, so start after it
+            after_id = self.stored_from - 1 if self.stored_from else self.compacted_upto
+            for stored in await conversation_store.load_messages(
+                self.thread.id, after_id=after_id
+            ):
+                self.window.append(stored)
+
+        if len(self.window) or self.compacted_upto:
+            logger.debug(
+                "Loaded %d stored messages for thread %s",
+                len(self.window),
+                self.thread.id,
+            )
+            if self.stored_from:
+                # Fetch the gap again before going back to the compacted summary
+                self._history_complete = False
+                self._oldest_fetched_id = self.stored_from
+            else:
+                # Anything older than the compacted summary is already in it
+                self._history_complete = bool(self.compacted_upto)
+
+            after = discord.Object(
+                id=(
+                    self.window[-1].message_id
+                    if len(self.window)
+                    else self.compacted_upto
+                )
+            )
+            # Newest first, so a thread that was busy while we were away costs one page instead of its backlog
+            newer = [
+                message
+                async for message in self.thread.history(
+                    limit=HISTORY_PAGE_SIZE, after=after, oldest_first=False
+                )
+            ]
+            if len(newer) >= HISTORY_PAGE_SIZE:
+                # There may be a gap after what we stored, start from the newest page and page back as needed
+                logger.debug(
+                    "Thread %s has at least %d new messages, dropping %d stored messages",
+                    self.thread.id,
+                    len(newer),
+                    len(self.window),
+                )
+                self.window = TokenWindow()
+                self._history_complete = False
+                self._oldest_fetched_id = newer[-1].id
+                # The stored messages stay, but only count from here until the gap is fetched again
+                self.stored_from = newer[-1].id
+                if conversation_store:
+                    conversation_store.save_thread(self)
+
+            for message in reversed(newer):
+                self.add(message)
+        else:
+            await self.load_older()
 
         if self.thread.name != bot_config.discord.default_thread_title:
             self.summary = self.thread.name
 
+    async def load_older(self) -> bool:
+        """Fetch the next page of Discord history older than what we have, newest first.
+
+        Returns whether there was any."""
+        if self._history_complete or self._compaction_task:
+            return False
+
+        # Page from the oldest message fetched, not kept, so a page that parses to nothing isn't fetched again
+        before_id = self._oldest_fetched_id or (
+            self.window[0].message_id if len(self.window) else None
+        )
+        before = discord.Object(id=before_id) if before_id else None
+        fetched = 0
+        older = []
+        with reply_stage_seconds.time("history_load"):
+            async for message in self.thread.history(
+                limit=HISTORY_PAGE_SIZE, before=before
+            ):
+                if self.compacted_upto and message.id <= self.compacted_upto:
+                    # Everything from here back is in the compacted summary
+                    self._history_complete = True
+                    break
+
+                fetched += 1
+                self._oldest_fetched_id = message.id
+                parsed = self._parse(message)
+                if parsed:
+                    older.append(parsed)
+
+        if fetched < HISTORY_PAGE_SIZE:
+            self._history_complete = True
+
+        if self.stored_from:
+            # What we fetched is stored too, so the stored messages are now complete further back
+            self.stored_from = (
+                None if self._history_complete else self._oldest_fetched_id
+            )
+            if conversation_store:
+                conversation_store.save_thread(self)
+
+        older.reverse()
+        self.window.extendleft(older)
+        logger.debug(
+            "Loaded %d older messages for thread %s", len(older), self.thread.id
+        )
+        return fetched > 0
+
     async def summarize(self):
         """Summarize the thread."""
         if self.summary:
             return self.summary
 
+        # Shielded so a caller giving up doesn't cancel the summary for everyone else
+        return await asyncio.shield(self.start_summary())
+
+    def start_summary(self) -> asyncio.Task[str]:
+        """Start summarizing the thread in the background, if it isn't already."""
+        if not self._summary_task:
+            self._summary_task = asyncio.create_task(self._summarize())
+            self._summary_task.add_done_callback(self._summary_done)
+        return self._summary_task
+
+    def _summary_done(self, task: asyncio.Task[str]):
+        if task.cancelled() or task.exception():
+            # Let the next caller try again
+            self._summary_task = None
+
+    async def _summarize(self):
         """Summarize a message into something shorter."""
-        summconvo = GptConversation(bot_config.openai.summarize_model)
+        summconvo = GptConversation(bot_config.openai.summarize_model, "summary")
         summresp = await summconvo.get_response(
             [
                 {
@@ -66,60 +301,220 @@ class ChatThread:
             ],
             max_tokens=25,
             temperature=0.5,
+            priority=PRIORITY_SUMMARY,
+            scope=self.scope,
+            policy=bot_config.openai.summary_policy,
         )
 
         self.summary = summresp
+        if conversation_store:
+            conversation_store.save_thread(self)
         return summresp
 
-    def get_messages(self) -> Iterable[dict[str, str]]:
-        return list(
-            filter(
-                lambda f: f is not None,
-                map(lambda m: m.to_conversation(self.bot_user), self.messages),
+    async def count_tokens(self, gpt_convo: GptConversation):
+        """Calculate token counts for this model on any messages that don't have one yet, in a single batch."""
+        missing = self.window.missing_token_counts(gpt_convo.model)
+        if not missing:
+            return
+
+        outbound_messages = [m.to_conversation(self.bot_user) for m in missing]
+        with reply_stage_seconds.time("tokenize"):
+            counts = iter(
+                await gpt_convo.calc_tokens_for_msgs(
+                    [m for m in outbound_messages if m is not None]
+                )
+            )
+        for message, outbound_message in zip(missing, outbound_messages):
+            message.set_token_count(
+                gpt_convo.model, next(counts) if outbound_message is not None else 0
             )
+
+    def get_token_limit(self, gpt_convo: GptConversation, token_limit=None) -> int:
+        return (
+            min(token_limit, gpt_convo.token_limit)
+            if token_limit and token_limit > 0
+            else gpt_convo.token_limit
         )
 
-    def get_messages_under_token_limit(
+    async def get_messages_under_token_limit(
         self, gpt_convo: GptConversation, token_limit=None
-    ) -> Generator[dict[str, str], None, str]:
-        use_token_limit = min(token_limit, gpt_convo.token_limit) if token_limit and token_limit > 0 else gpt_convo.token_limit
+    ) -> tuple[list[dict[str, str]], bool, int]:
+        """Get the newest messages that fit in the token limit, whether older messages were left out, and how many
+        tokens the messages use."""
+        use_token_limit = self.get_token_limit(gpt_convo, token_limit)
+
+        while True:
+            # Messages are only ever encoded once per model
+            await self.count_tokens(gpt_convo)
+
+            start, token_overflow = self.window.cutoff(gpt_convo.model, use_token_limit)
+            # Page in older history until the limit is full or there isn't any more
+            if token_overflow or not await self.load_older():
+                break
+
+        if bot_config.threads.compress_min_bytes:
+            # Older messages are only kept around for compaction or a fallback model with a bigger context
+            self.window.compress(start, bot_config.threads.compress_min_bytes)
+
+        messages = []
         token_count = 0
+        for message in islice(self.window, start, None):
+            outbound_message = message.to_conversation(self.bot_user)
+            if outbound_message is not None:
+                messages.append(outbound_message)
+                token_count += message.token_count(gpt_convo.model)
 
-        for outbound_message in reversed(self.get_messages()):
-            new_tokens = gpt_convo.calc_tokens_for_msg(outbound_message)
-            if token_count + new_tokens < use_token_limit:
-                # We have enough tokens so add this to the conversation history
-                token_count += new_tokens
-                yield outbound_message
-            else:
-                # We don't have enough tokens to replay the entire conversation
-                return "token_overflow"
+        return messages, token_overflow, token_count
 
-    async def continue_thread(self, token_limit=None) -> str:
-        await self.summarize()  # Ensure we've summarized the thread so the continuation has a value
+    async def get_prompt(
+        self, gpt_convo: GptConversation, token_limit=None
+    ) -> tuple[list[dict[str, str]], int]:
+        """Build the message list to send for the next reply, and estimate its size in tokens."""
+        messages, token_overflow, token_count = (
+            await self.get_messages_under_token_limit(gpt_convo, token_limit)
+        )
 
-        gpt_convo = GptConversation()
-        token_overflow = False
+        if token_overflow and bot_config.openai.compaction:
+            # Fold the older messages into the running summary for next time
+            self.start_compaction(
+                gpt_convo.model,
+                int(
+                    self.get_token_limit(gpt_convo, token_limit)
+                    * bot_config.openai.compaction_keep_ratio
+                ),
+            )
 
-        messages: list[ChatThreadMessage] = []
-        try:
-            for outbound_message in self.get_messages_under_token_limit(
-                gpt_convo, token_limit
-            ):
-                # Insert upside-down
-                messages.insert(0, outbound_message)
-        except StopIteration as e:
-            if e.value == "token_overflow":
-                # We had a token overflow
-                token_overflow = True
-
-        if token_overflow:
-            # We went over the tokens, so use the continuation system message
-            messages.insert(
-                0, {"role": "system", "content": self.system_message_continuation}
+        system = [{"role": "system", "content": self.system_message}]
+        if token_overflow or self.compacted_summary:
+            # We went over the tokens, so add the continuation system message. Only this needs the summary.
+            with reply_stage_seconds.time("summary"):
+                await self.summarize()
+            system.append(
+                {"role": "system", "content": self.system_message_continuation}
             )
-        else:
-            # We're under the token limit so use the starting system message
-            messages.insert(0, {"role": "system", "content": self.system_message})
 
-        return await gpt_convo.get_response(messages)
+        token_count += sum(await gpt_convo.calc_tokens_for_msgs(system))
+        token_count += 3  # every reply is primed with <|start|>assistant<|message|>
+
+        return [*system, *messages], token_count
+
+    def start_compaction(self, model: str, keep_tokens: int):
+        """Start compacting everything older than the newest keep_tokens worth of messages, if we aren't already."""
+        if self._compaction_task:
+            return
+
+        start, _ = self.window.cutoff(model, keep_tokens)
+        if start < 1:
+            return
+
+        self._compaction_task = asyncio.create_task(
+            self._compact(list(islice(self.window, 0, start)))
+        )
+        self._compaction_task.add_done_callback(self._compaction_done)
+
+    def _compaction_done(self, task: asyncio.Task[None]):
+        self._compaction_task = None
+        if not task.cancelled() and task.exception():
+            logger.error(
+                "Failed to compact thread %s", self.thread.id, exc_info=task.exception()
+            )
+
+    async def _compact(self, messages: list[ChatThreadMessage]):
+        """Fold messages into the running summary and drop them from the window."""
+        transcript = "\n\n".join(
+            f"{outbound_message['role']}: {outbound_message['content']}"
+            for outbound_message in map(
+                lambda m: m.to_conversation(self.bot_user), messages
+            )
+            if outbound_message is not None
+        )
+
+        summconvo = GptConversation(bot_config.openai.summarize_model, "compaction")
+        summresp = await summconvo.get_response(
+            [
+                {"role": "system", "content": bot_config.openai.compaction_prompt},
+                {
+                    "role": "user",
+                    "content": f"Summary so far:\n{self.compacted_summary or '(none)'}\n\nNew messages:\n{transcript}",
+                },
+            ],
+            max_tokens=bot_config.openai.compaction_token_limit,
+            temperature=0.5,
+            priority=PRIORITY_SUMMARY,
+            scope=self.scope,
+            policy=bot_config.openai.summary_policy,
+        )
+
+        # The window may have changed while we waited, only drop what we summarized
+        compacted = {id(m) for m in messages}
+        while len(self.window) and id(self.window[0]) in compacted:
+            self.window.popleft()
+
+        self.compacted_summary = summresp
+        self.compacted_upto = messages[-1].message_id
+        self._history_complete = True
+        logger.debug(
+            "Compacted %d messages in thread %s", len(messages), self.thread.id
+        )
+
+        if conversation_store:
+            conversation_store.save_thread(self)
+
+    async def estimate_prompt_tokens(
+        self, gpt_convo: GptConversation, token_limit=None
+    ) -> int:
+        """Estimate the prompt size from the messages already loaded, without paging in history or summarizing."""
+        await self.count_tokens(gpt_convo)
+        system = [
+            {"role": "system", "content": self.system_message},
+            {"role": "system", "content": self.system_message_continuation},
+        ]
+        return (
+            min(
+                self.window.total_tokens(gpt_convo.model),
+                self.get_token_limit(gpt_convo, token_limit),
+            )
+            + sum(await gpt_convo.calc_tokens_for_msgs(system))
+            + 3
+        )
+
+    async def get_routed_prompt(
+        self, token_limit=None
+    ) -> tuple[GptConversation, list[dict[str, str]], int]:
+        """Pick the model for the next reply and build the prompt for it."""
+        primary = GptConversation()
+        # Route before building, so paging in history and compaction are sized for the model that's used
+        model = model_router.choose(
+            primary.model, await self.estimate_prompt_tokens(primary, token_limit)
+        )
+        gpt_convo = primary if model == primary.model else GptConversation(model)
+        prompt, prompt_tokens = await self.get_prompt(gpt_convo, token_limit)
+
+        return gpt_convo, prompt, prompt_tokens
+
+    def _remember_usage(self, gpt_convo: GptConversation, text: str):
+        if gpt_convo.last_usage:
+            self._reply_usage = (
+                gpt_convo.model,
+                text,
+                gpt_convo.last_usage.completion_tokens,
+            )
+
+    async def continue_thread(self, token_limit=None) -> str:
+        gpt_convo, prompt, prompt_tokens = await self.get_routed_prompt(token_limit)
+        resp = await gpt_convo.get_response(
+            prompt, prompt_tokens=prompt_tokens, scope=self.scope
+        )
+        self._remember_usage(gpt_convo, resp)
+        return resp
+
+    async def continue_thread_stream(self, token_limit=None) -> AsyncIterator[str]:
+        """Continue the thread, yielding the reply text as it's generated."""
+        gpt_convo, prompt, prompt_tokens = await self.get_routed_prompt(token_limit)
+        parts = []
+        async for text in gpt_convo.get_response_stream(
+            prompt, prompt_tokens=prompt_tokens, scope=self.scope
+        ):
+            parts.append(text)
+            yield text
+        self._remember_usage(gpt_convo, "".join(parts))
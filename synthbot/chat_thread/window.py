@@ -0,0 +1,107 @@
+from bisect import bisect_right
+from collections import deque
+from typing import Iterator
+
+from .message import ChatThreadMessage
+
+
+class TokenWindow:
+    """A deque of thread messages with running per-model token prefix sums.
+
+    Each message carries its own token counts, so the prefix sums are only extended as messages are added,
+    and finding the cutoff for a token limit is a binary search instead of re-encoding the history.
+    """
+
+    messages: deque[ChatThreadMessage]
+    # model -> (absolute index of the first entry, cumulative token counts starting at 0)
+    _prefix: dict[str, tuple[int, list[int]]]
+    # Number of messages popped from the left since the prefix sums were started
+    _dropped: int
+    # Size of all message text as stored
+    text_bytes: int
+    message_ids: set[int]
+
+    def __init__(self):
+        self.messages = deque()
+        self._prefix = {}
+        self._dropped = 0
+        self.text_bytes = 0
+        self.message_ids = set()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self) -> Iterator[ChatThreadMessage]:
+        return iter(self.messages)
+
+    def __getitem__(self, index: int) -> ChatThreadMessage:
+        return self.messages[index]
+
+    def append(self, message: ChatThreadMessage):
+        self.messages.append(message)
+        self.text_bytes += message.size_bytes
+        self.message_ids.add(message.message_id)
+
+    def extendleft(self, messages: list[ChatThreadMessage]):
+        """Add older messages, oldest first, to the start of the window."""
+        self.messages.extendleft(reversed(messages))
+        for message in messages:
+            self.text_bytes += message.size_bytes
+            self.message_ids.add(message.message_id)
+
+        # Indexes have all shifted, rebuild the sums on the next lookup
+        self._prefix.clear()
+        self._dropped = 0
+
+    def popleft(self) -> ChatThreadMessage:
+        message = self.messages.popleft()
+        self._dropped += 1
+        self.text_bytes -= message.size_bytes
+        self.message_ids.discard(message.message_id)
+
+        for model, (base, prefix) in list(self._prefix.items()):
+            stale = self._dropped - base
+            if stale >= len(prefix):
+                # The sums never reached the remaining messages, start over on the next lookup
+                del self._prefix[model]
+            elif stale > len(prefix) // 2:
+                # Trim entries that only refer to dropped messages once they make up half the list
+                self._prefix[model] = (self._dropped, prefix[stale:])
+
+        return message
+
+    def compress(self, end: int, min_bytes: int):
+        """Compress the text of large messages before index end."""
+        for i in range(end):
+            self.text_bytes -= self.messages[i].compress(min_bytes)
+
+    def missing_token_counts(self, model: str) -> list[ChatThreadMessage]:
+        """Get the messages that don't have a token count for this model yet."""
+        return [m for m in self.messages if m.token_count(model) is None]
+
+    def _prefix_for(self, model: str) -> tuple[int, list[int]]:
+        base, prefix = self._prefix.get(model, (self._dropped, [0]))
+
+        # Extend the running sums with any messages appended since the last lookup
+        known = base + len(prefix) - 1 - self._dropped
+        for i in range(known, len(self.messages)):
+            prefix.append(prefix[-1] + self.messages[i].token_count(model))
+
+        self._prefix[model] = (base, prefix)
+        return base, prefix
+
+    def total_tokens(self, model: str) -> int:
+        base, prefix = self._prefix_for(model)
+        return prefix[-1] - prefix[self._dropped - base]
+
+    def cutoff(self, model: str, token_limit: int) -> tuple[int, bool]:
+        """Find the oldest message index that keeps the newest messages under the token limit.
+
+        Returns the index and whether any tokens had to be left out."""
+        base, prefix = self._prefix_for(model)
+        first = self._dropped - base
+        total = prefix[-1]
+
+        # Smallest index where the tokens from there to the end are under the limit
+        index = max(bisect_right(prefix, total - token_limit, lo=first), first)
+        return index - first, prefix[index] > prefix[first]
@@ -7,6 +7,21 @@ from typing import Optional
 @define
 class BotConfig:
     debug: bool = field(default=False)
+    # Directory with tiktoken's encoding files, so they don't have to be downloaded on startup
+    tokenizer_cache_dir: Optional[str] = field(default=None)
+    # Serve Prometheus metrics at /metrics on this port
+    metrics_port: Optional[int] = field(default=None)
+    metrics_host: str = field(default="0.0.0.0")
+    # Log the event loop's stack when it's blocked for this many seconds, or never if unset
+    loop_stall_threshold: Optional[float] = field(default=1)
+    # How often to measure event loop lag, in seconds
+    loop_lag_interval: float = field(default=0.5)
+    # Log one JSON object per line instead of text
+    log_json: bool = field(default=False)
+    # Longer log messages are cut off, noting their length and a hash of the full message
+    log_max_length: Optional[int] = field(default=2000)
+    # Logger name -> share of its debug messages to keep, e.g. {"synthbot.chat_thread.message": 0.1}
+    log_sample_rates: dict[str, float] = field(factory=dict)
 
 
 @define
@@ -18,19 +33,99 @@ class DiscordConfig:
     admin_users: Optional[list[int]] = field(default=None)
 
 
+@define
+class RateLimitConfig:
+    requests_per_minute: Optional[int] = field(default=None)
+    tokens_per_minute: Optional[int] = field(default=None)
+
+
+@define
+class CallPolicyConfig:
+    # Seconds to wait for each attempt
+    timeout: Optional[float] = field(default=60)
+    # Retries for timeouts, connection errors and server errors
+    max_retries: int = field(default=2)
+    backoff_base: float = field(default=1)
+    backoff_max: float = field(default=10)
+    # Send a second request if the first is slower than the model's recent p95, and use whichever finishes first
+    hedge: bool = field(default=False)
+    # Never hedge sooner than this many seconds
+    hedge_min_delay: float = field(default=5)
+    # Reuse responses to identical requests
+    cache: bool = field(default=False)
+
+
 @define
 class OpenAIConfig:
     api_key: str
     model: Optional[str] = field(default="gpt-4o")
     summarize_model: Optional[str] = field(default="gpt-4o-mini")
-    summarize_prompt: Optional[str] = field(default="Give a short summary in 8 words or less. Rephrase the prompt only.")
+    summarize_prompt: Optional[str] = field(
+        default="Give a short summary in 8 words or less. Rephrase the prompt only."
+    )
     thread_token_limit: Optional[int] = field(default=None)
     reply_token_limit: Optional[int] = field(default=512)
+    # Fold messages that no longer fit in the thread token limit into a running summary
+    compaction: bool = field(default=True)
+    compaction_prompt: Optional[str] = field(
+        default="Update the summary of the earlier conversation with the new messages. Keep names, facts, decisions and open questions. Reply with only the updated summary, in 200 words or less."
+    )
+    compaction_token_limit: Optional[int] = field(default=300)
+    # Share of the thread token limit to keep as full messages after compacting
+    compaction_keep_ratio: float = field(default=0.5)
+    # Per-model request budgets, keyed by model name. Requests queue up instead of going over these.
+    rate_limits: dict[str, RateLimitConfig] = field(factory=dict)
+    # How many times to wait and retry when OpenAI rate limits us anyway
+    rate_limit_retries: int = field(default=3)
+    # Models to use instead when the primary is slow, failing or too small for the prompt, in order of preference
+    fallback_models: list[str] = field(factory=list)
+    # Target p95 latency in seconds. Models slower than this are skipped while there's a fallback.
+    latency_slo: Optional[float] = field(default=None)
+    router_max_error_rate: float = field(default=0.25)
+    router_min_samples: int = field(default=5)
+    router_window_seconds: float = field(default=300)
+    reply_policy: CallPolicyConfig = field(default=CallPolicyConfig())
+    summary_policy: CallPolicyConfig = field(
+        default=CallPolicyConfig(timeout=15, max_retries=1, cache=True)
+    )
+    response_cache_size: int = field(default=1000)
+    response_cache_ttl: int = field(default=24 * 60 * 60)
+    # SQLite file to keep cached responses in across restarts
+    response_cache_path: Optional[str] = field(default=None)
+    # Post replies as they're generated, editing the message as more text arrives
+    stream: bool = field(default=False)
+    # Minimum seconds between edits of a streaming reply. Discord allows about 5 edits per 5 seconds.
+    stream_edit_interval: float = field(default=1.5)
+
+
+@define
+class ChatThreadConfig:
+    # Idle threads past these limits are dropped from memory and reloaded when they're next used
+    max_cached_threads: int = field(default=500)
+    max_cached_bytes: int = field(default=64 * 1024 * 1024)
+    # SQLite file to keep parsed thread messages in, so restarts only fetch new messages from Discord
+    store_path: Optional[str] = field(default=None)
+    # Compress the text of messages at least this many bytes once they no longer fit in the prompt
+    compress_min_bytes: Optional[int] = field(default=None)
 
 
 @define
 class ScryfallConfig:
     enabled: bool = field(default=True)
+    # Scryfall asks for no more than 10 requests per second
+    requests_per_second: float = field(default=10)
+    max_connections: int = field(default=10)
+    timeout: float = field(default=10)
+    cache_size: int = field(default=5000)
+    cache_ttl: int = field(default=7 * 24 * 60 * 60)
+    # How long to remember that a card name doesn't exist
+    negative_cache_ttl: int = field(default=60 * 60)
+    # SQLite file to keep the card cache in across restarts
+    cache_path: Optional[str] = field(default=None)
+    # Look cards up in a local Scryfall bulk data file (ideally "Oracle Cards") instead of the API
+    bulk_data_path: Optional[str] = field(default=None)
+    # How often to check the bulk data file for changes, in seconds
+    bulk_data_reload_interval: int = field(default=60 * 60)
 
 
 @define
@@ -38,12 +133,17 @@ class SynthbotConfig:
     discord: DiscordConfig
     openai: OpenAIConfig
     bot: BotConfig = field(default=BotConfig())
+    threads: ChatThreadConfig = field(default=ChatThreadConfig())
     scryfall: ScryfallConfig = field(default=ScryfallConfig())
 
 
 def get_config() -> SynthbotConfig:
     with open("config.yaml", "r") as f:
         config = yaml.safe_load(f)
+        # A section with every key commented out loads as null, so treat it as missing
+        config = {
+            section: values for section, values in config.items() if values is not None
+        }
         return cattrs.structure(config, SynthbotConfig)
 
 
@@ -1,21 +1,41 @@
+import asyncio
 import discord
+import io
+import json
 import logging
+import math
 from openai import APIError
+import resource
+import time
 
-from .chat_thread import ChatThreadManager
+from .chat_thread import ChatThread, ChatThreadManager
 from .config import bot_config
-from .scryfall import get_mtg_embeds_from_message
+from .gpt import hedge_stats, model_router
+from .metrics import reply_errors, reply_stage_seconds
+from .profiler import SamplingProfiler
+from .response_cache import response_cache
+from .scheduler import scheduler
+from .scryfall import CARD_CACHE, get_mtg_embeds_from_message
+from .usage import usage_tracker
 
 logger = logging.getLogger(__name__)
 
+ADMIN_HELP = """Hello! I am Synthgen GPT, your personal synth assistant.
+Commands:
+`stats` - dump internal state
+`profile [seconds]` - profile the event loop (default 30s, max 300s) and send the report
+`profile stop` - stop profiling early"""
+
 
 class SynthbotCore:
     client: discord.Client
     thread_mgr: ChatThreadManager
+    profiler: SamplingProfiler
 
     def __init__(self, client: discord.Client):
         self.client = client
         self.thread_mgr = ChatThreadManager()
+        self.profiler = SamplingProfiler()
 
     async def on_dm_message(self, message: discord.Message):
         """Do a DM response"""
@@ -28,8 +48,82 @@ class SynthbotCore:
             )
             return
 
-        await message.channel.send(
-            "Hello! I am Synthgen GPT, your personal synth assistant."
+        command, *args = message.content.split() or [""]
+        if command == "stats":
+            await self.send_stats(message.channel)
+        elif command == "profile" and args == ["stop"]:
+            self.profiler.stop()
+        elif command == "profile":
+            await self.run_profiler(message.channel, args)
+        else:
+            await message.channel.send(ADMIN_HELP)
+
+    def get_stats(self) -> dict:
+        """Get a snapshot of the bot's internals."""
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+
+        watchdog = getattr(self.client, "watchdog", None)
+        return {
+            "memory": {
+                "rss_mb": rss_pages * resource.getpagesize() / 2**20,
+                # ru_maxrss is in KiB on Linux
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                / 2**10,
+            },
+            "threads": self.thread_mgr.stats,
+            "card_cache": CARD_CACHE.stats,
+            "response_cache": response_cache.stats,
+            "openai": {
+                "in_flight": scheduler.in_flight,
+                "queue_depth": scheduler.queue_depth,
+                "hedged": dict(hedge_stats),
+                "usage": usage_tracker.stats,
+                "usage_by_guild": usage_tracker.guild_stats,
+                "usage_top_threads": usage_tracker.top_threads(),
+                "latency": model_router.stats,
+                "routing": model_router.decision_stats,
+            },
+            "event_loop_lag": (
+                {f"p{p}": watchdog.percentile(p) for p in (50, 90, 99)}
+                if watchdog
+                else None
+            ),
+            "asyncio_tasks": len(asyncio.all_tasks()),
+        }
+
+    async def send_stats(self, channel: discord.abc.Messageable):
+        stats = json.dumps(self.get_stats(), indent=2)
+        if len(stats) < 1980:
+            await channel.send(f"```json\n{stats}\n```")
+        else:
+            await channel.send(
+                file=discord.File(io.BytesIO(stats.encode()), filename="stats.json")
+            )
+
+    async def run_profiler(self, channel: discord.abc.Messageable, args: list[str]):
+        if self.profiler.running:
+            await channel.send(
+                "Already profiling, send `profile stop` to finish early."
+            )
+            return
+
+        try:
+            seconds = float(args[0]) if args else 30
+        except ValueError:
+            seconds = None
+        if not seconds or not math.isfinite(seconds) or seconds <= 0:
+            await channel.send(ADMIN_HELP)
+            return
+        seconds = min(300, seconds)
+
+        # Started before anything is awaited, so a second command sees it running
+        self.profiler.start(seconds)
+        await channel.send(f"Profiling for up to {seconds:g}s.")
+        report = await self.profiler.wait()
+        await channel.send(
+            "Profile finished.",
+            file=discord.File(io.BytesIO(report.encode()), filename="profile.txt"),
         )
 
     async def on_channel_message(self, message: discord.Message):
@@ -40,6 +134,8 @@ class SynthbotCore:
             auto_archive_duration=1440,
             reason="ChatGPT conversation",
         )
+        # We know everything that's in it, so skip fetching its history
+        self.thread_mgr.add_new_thread(self.client.user, response_thread, message)
 
         await self.handle_response_thread(message, response_thread)
 
@@ -54,57 +150,132 @@ class SynthbotCore:
         response_thread: discord.Thread,
     ):
         """Reply to the thread"""
-        async with response_thread.typing():
+        with reply_stage_seconds.time("total"):
+            await self._handle_response_thread(message, response_thread)
+
+    async def _handle_response_thread(
+        self,
+        message: discord.Message,
+        response_thread: discord.Thread,
+    ):
+        log_context = {"thread_id": response_thread.id, "message_id": message.id}
+
+        # Take our turn in the thread before typing so replies stay in the order they arrived
+        async with self.thread_mgr.use_thread(
+            self.client.user, response_thread
+        ) as convo, response_thread.typing():
             # Build the OpenAI conversation
-            convo = await self.thread_mgr.get_thread(self.client.user, response_thread)
             convo.add(message)
 
+            rename_task = None
             if response_thread.name == bot_config.discord.default_thread_title:
-                # Summarize the thread prompt into something shorter for the thread title.
-                try:
-                    summary_resp = await convo.summarize()
-                    await response_thread.edit(name=summary_resp)
-                except APIError as e:
-                    logger.exception(
-                        "Got an error while trying to summarize the conversation"
-                    )
+                # Summarize the thread prompt into something shorter for the thread title, alongside the reply
+                rename_task = asyncio.create_task(
+                    self.rename_thread(convo, response_thread)
+                )
 
             # Fetch the OpenAI response
+            placeholder = None
             try:
-                resp = await convo.continue_thread()
+                if bot_config.openai.stream:
+                    # Post early and fill the message in as the response arrives
+                    placeholder = await response_thread.send(
+                        "…", allowed_mentions=discord.AllowedMentions.none()
+                    )
+                    with reply_stage_seconds.time("completion"):
+                        resp = await self.stream_response(convo, placeholder)
+                else:
+                    with reply_stage_seconds.time("completion"):
+                        resp = await convo.continue_thread()
                 logger.debug(
-                    "Thread %s got OpenAI response: %s", message.channel.name, resp
+                    "Thread %s got OpenAI response: %s",
+                    message.channel.name,
+                    resp,
+                    extra=log_context,
                 )
-            except APIError as e:
+            except (APIError, asyncio.TimeoutError) as e:
                 logger.exception(
-                    "Got an error while trying to get a conversation response"
+                    "Got an error while trying to get a conversation response",
+                    extra=log_context,
                 )
+                reply_errors.inc(type(e).__name__)
 
                 try:
-                    await response_thread.send(
-                        f"---\nError while getting a conversation response:\n```{repr(e)}```"
-                    )
+                    error_text = f"---\nError while getting a conversation response:\n```{repr(e)}```"
+                    if placeholder:
+                        await placeholder.edit(content=error_text)
+                    else:
+                        await response_thread.send(error_text)
                 except Exception:
                     logger.exception(
                         "Got an error trying to talk to Discord when complaining about a conversation response!"
                     )
 
+                if rename_task:
+                    await rename_task
                 return
 
             # Look up Magic cards
             embeds = None
             if bot_config.scryfall.enabled:
-                embeds = await get_mtg_embeds_from_message(resp)
+                with reply_stage_seconds.time("scryfall"):
+                    embeds = await get_mtg_embeds_from_message(resp)
 
             # Trim response to fit in Discord's 2000 character limit. The convo still contains the whole message.
-            # short_resp = textwrap.shorten(resp, width=2000, placeholder="...") # this removes whitespace
-            short_resp = (resp[:1996] + "...") if len(resp) > 1999 else resp
+            short_resp = shorten_response(resp)
 
-            msg = await response_thread.send(
-                short_resp,
-                allowed_mentions=discord.AllowedMentions.none(),
-                embeds=embeds,
-            )
+            with reply_stage_seconds.time("send"):
+                if placeholder:
+                    msg = await placeholder.edit(
+                        content=short_resp, embeds=embeds or []
+                    )
+                else:
+                    msg = await response_thread.send(
+                        short_resp,
+                        allowed_mentions=discord.AllowedMentions.none(),
+                        embeds=embeds,
+                    )
             convo.add(msg, full_text=resp)
 
-            logger.debug("Thread %s was updated", message.channel.name)
+            if rename_task:
+                await rename_task
+
+            logger.debug(
+                "Thread %s was updated", message.channel.name, extra=log_context
+            )
+
+    async def rename_thread(self, convo: ChatThread, response_thread: discord.Thread):
+        """Rename the thread to its summary once it's ready."""
+        try:
+            summary_resp = await convo.summarize()
+            await response_thread.edit(name=summary_resp)
+        except (APIError, asyncio.TimeoutError) as e:
+            logger.exception("Got an error while trying to summarize the conversation")
+        except discord.HTTPException:
+            logger.exception("Got an error while trying to rename the thread")
+
+    async def stream_response(
+        self, convo: ChatThread, placeholder: discord.Message
+    ) -> str:
+        """Stream the thread's next response into a message, editing it at a limited rate."""
+        parts = []
+        last_edit = time.monotonic()
+        edited_len = 0
+
+        async for text in convo.continue_thread_stream():
+            parts.append(text)
+
+            if time.monotonic() - last_edit >= bot_config.openai.stream_edit_interval:
+                resp = "".join(parts)
+                if len(resp) != edited_len:
+                    await placeholder.edit(content=shorten_response(resp + " …"))
+                    edited_len = len(resp)
+                last_edit = time.monotonic()
+
+        return "".join(parts)
+
+
+def shorten_response(resp: str) -> str:
+    """Trim a response to fit in Discord's 2000 character limit."""
+    # textwrap.shorten(resp, width=2000, placeholder="...") removes whitespace
+    return (resp[:1996] + "...") if len(resp) > 1999 else resp
@@ -1,9 +1,21 @@
+import asyncio
 import discord
 import discordhealthcheck
 import logging
 
+from .chat_thread.store import conversation_store
 from .config import bot_config
 from .core import SynthbotCore
+from .gpt import hedge_stats, model_router
+from .metrics import MetricsServer, metrics
+from .response_cache import response_cache
+from .scheduler import scheduler
+from .scryfall import BULK_INDEX, CARD_CACHE
+from .scryfall.client import scryfall_client
+from .startup import since_start, startup_stage, startup_timings
+from .tokenizer import tokenizer
+from .usage import usage_tracker
+from .watchdog import LoopWatchdog
 
 
 logger = logging.getLogger(__name__)
@@ -18,9 +30,139 @@ class SynthbotClient(discord.Client):
     def __init__(self):
         super().__init__(intents=intents)
         self.botcore = SynthbotCore(self)
+        self.metrics_server = None
+        self.watchdog = None
 
     async def setup_hook(self):
-        self.healthcheck_server = await discordhealthcheck.start(self)
+        if bot_config.bot.loop_stall_threshold:
+            self.watchdog = LoopWatchdog(
+                bot_config.bot.loop_lag_interval, bot_config.bot.loop_stall_threshold
+            )
+            self.watchdog.start()
+
+        # In the background. Anything that needs an encoding sooner waits for the same load.
+        self.warmup_task = asyncio.create_task(self.warmup())
+
+        with startup_stage("healthcheck"):
+            self.healthcheck_server = await discordhealthcheck.start(self)
+        if bot_config.bot.metrics_port:
+            self.register_metrics()
+            with startup_stage("metrics"):
+                self.metrics_server = MetricsServer(metrics)
+                await self.metrics_server.start(
+                    bot_config.bot.metrics_host, bot_config.bot.metrics_port
+                )
+        with startup_stage("card_cache"):
+            await CARD_CACHE.load()
+        with startup_stage("response_cache"):
+            await response_cache.cache.load()
+        if BULK_INDEX:
+            BULK_INDEX.start(bot_config.scryfall.bulk_data_reload_interval)
+
+    async def warmup(self):
+        models = [
+            bot_config.openai.model,
+            bot_config.openai.summarize_model,
+            *bot_config.openai.fallback_models,
+        ]
+        with startup_stage("tokenizer"):
+            await tokenizer.warmup(models)
+
+    def register_metrics(self):
+        thread_mgr = self.botcore.thread_mgr
+        caches = {
+            "responses": response_cache.cache,
+            "cards": CARD_CACHE,
+            "threads": thread_mgr,
+        }
+
+        metrics.collect(
+            "synthbot_openai_queue_depth",
+            "OpenAI requests waiting for rate limit budget",
+            "gauge",
+            (),
+            lambda: {(): scheduler.queue_depth},
+        )
+        metrics.collect(
+            "synthbot_openai_in_flight",
+            "OpenAI requests waiting for a response",
+            "gauge",
+            (),
+            lambda: {(): scheduler.in_flight},
+        )
+        metrics.collect(
+            "synthbot_openai_hedged_requests_total",
+            "Second requests sent because the first was slow",
+            "counter",
+            ("model",),
+            lambda: {(model,): count for model, count in hedge_stats.items()},
+        )
+        metrics.collect(
+            "synthbot_model_route_decisions_total",
+            "Models chosen for requests, and why",
+            "counter",
+            ("primary", "chosen", "reason"),
+            lambda: dict(model_router.decisions),
+        )
+        metrics.collect(
+            "synthbot_openai_tokens_total",
+            "Tokens used as reported by OpenAI",
+            "counter",
+            ("model", "kind"),
+            lambda: {
+                (model, kind): getattr(usage, f"{kind}_tokens")
+                for model, usage in usage_tracker.by_model.items()
+                for kind in ("prompt", "completion", "cached")
+            },
+        )
+        metrics.collect(
+            "synthbot_guild_tokens_total",
+            "Tokens used per guild as reported by OpenAI",
+            "counter",
+            ("guild", "kind"),
+            lambda: {
+                (str(guild_id), kind): getattr(usage, f"{kind}_tokens")
+                for guild_id, usage in usage_tracker.by_guild.items()
+                for kind in ("prompt", "completion", "cached")
+            },
+        )
+        metrics.collect(
+            "synthbot_cache_hits_total",
+            "Cache lookups that found an entry",
+            "counter",
+            ("cache",),
+            lambda: {(name,): cache.hits for name, cache in caches.items()},
+        )
+        metrics.collect(
+            "synthbot_cache_misses_total",
+            "Cache lookups that didn't find an entry",
+            "counter",
+            ("cache",),
+            lambda: {(name,): cache.misses for name, cache in caches.items()},
+        )
+        metrics.collect(
+            "synthbot_cached_threads",
+            "Threads held in memory",
+            "gauge",
+            (),
+            lambda: {(): len(thread_mgr.threads)},
+        )
+
+    async def close(self):
+        if self.watchdog:
+            self.watchdog.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        if BULK_INDEX:
+            BULK_INDEX.stop()
+        await scryfall_client.close()
+        if CARD_CACHE.store:
+            CARD_CACHE.store.close()
+        if response_cache.cache.store:
+            response_cache.cache.store.close()
+        if conversation_store:
+            conversation_store.close()
+        await super().close()
 
 
 client = SynthbotClient()
@@ -28,7 +170,14 @@ client = SynthbotClient()
 
 @client.event
 async def on_ready():
-    logger.info("Logged in as %s", client.user)
+    logger.info(
+        "Logged in as %s, ready %.2fs after starting (%s)",
+        client.user,
+        since_start(),
+        ", ".join(
+            f"{stage} {seconds:.2f}s" for stage, seconds in startup_timings.items()
+        ),
+    )
     await client.change_presence(
         status=discord.Status.online,
         activity=discord.Activity(
@@ -1,8 +1,23 @@
-from openai import AsyncOpenAI
-import tiktoken
+import asyncio
+from collections import Counter
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    InternalServerError,
+    RateLimitError,
+)
 import logging
+import random
+import time
+from typing import AsyncIterator, Callable, Optional
 
-from .config import bot_config
+from .config import CallPolicyConfig, bot_config
+from .metrics import openai_errors, openai_request_seconds
+from .response_cache import ResponseCache, response_cache
+from .router import ModelRouter
+from .scheduler import PRIORITY_REPLY, scheduler
+from .tokenizer import tokenizer
+from .usage import RequestScope, usage_tracker
 
 # GPT models we want to support, values are their input token limits.
 AVAILABLE_MODELS: dict[str, int] = {
@@ -31,73 +46,342 @@ AVAILABLE_MODELS.update(
 
 
 logger = logging.getLogger(__name__)
-openai_client = AsyncOpenAI(api_key=bot_config.openai.api_key)
+# Retries are handled by our own call policies, see GptConversation._create
+openai_client = AsyncOpenAI(api_key=bot_config.openai.api_key, max_retries=0)
+model_router = ModelRouter(AVAILABLE_MODELS)
+
+# Errors worth trying again. APITimeoutError is an APIConnectionError, asyncio.TimeoutError is our own deadline.
+RETRYABLE_ERRORS = (APIConnectionError, InternalServerError, asyncio.TimeoutError)
+
+# model -> number of hedged requests sent
+hedge_stats: Counter[str] = Counter()
 
 
 class GptConversation:
     model: str
 
-    def __init__(self, model: str = None):
+    def __init__(self, model: str = None, call_type: str = "reply"):
         self.model = model or bot_config.openai.model
+        # What the completions are for, used in metrics
+        self.call_type = call_type
+        # Usage OpenAI reported for the last completion
+        self.last_usage = None
 
     async def get_response(
         self,
         message_list: list[dict[str, str]],
         max_tokens: int = None,
         temperature: float = 1,
+        prompt_tokens: int = None,
+        priority: int = PRIORITY_REPLY,
+        scope: RequestScope = None,
+        policy: CallPolicyConfig = None,
     ) -> str:
-        """Get a GPT completion for the current message history."""
-        logger.debug("Requesting response from ChatGPT with messages: %s", message_list)
-
-        completion = await openai_client.chat.completions.create(
-            model=self.model,
-            max_tokens=max_tokens or bot_config.openai.reply_token_limit,
-            temperature=temperature,
-            messages=message_list,
+        """Get a GPT completion for the current message history.
+
+        The request waits its turn in the scheduler, using prompt_tokens (or a fresh count) for the token budget,
+        and is retried, hedged or cached according to the call policy."""
+        policy = policy or bot_config.openai.reply_policy
+        self.last_usage = None
+        request = {
+            "messages": message_list,
+            "max_tokens": max_tokens or bot_config.openai.reply_token_limit,
+            "temperature": temperature,
+        }
+
+        if policy.cache:
+            key = ResponseCache.key(
+                self.model, temperature, request["max_tokens"], message_list
+            )
+            return await response_cache.get_or_create(
+                key,
+                lambda: self._get_response(
+                    request, prompt_tokens, priority, scope, policy
+                ),
+            )
+
+        return await self._get_response(request, prompt_tokens, priority, scope, policy)
+
+    async def _get_response(
+        self,
+        request: dict,
+        prompt_tokens: int,
+        priority: int,
+        scope: Optional[RequestScope],
+        policy: CallPolicyConfig,
+    ) -> str:
+        log_context = scope.log_context(self.model) if scope else {"model": self.model}
+        logger.debug(
+            "Requesting response from ChatGPT with messages: %s",
+            request["messages"],
+            extra=log_context,
         )
+        if prompt_tokens is None:
+            prompt_tokens = await num_tokens_from_messages(
+                request["messages"], self.model
+            )
+
+        scheduler.in_flight += 1
+        try:
+            completion = await self._create(
+                request, prompt_tokens, priority, scope, policy
+            )
+        finally:
+            scheduler.in_flight -= 1
 
-        logger.debug("Got response from ChatGPT: %s", completion)
+        logger.debug("Got response from ChatGPT: %s", completion, extra=log_context)
+        usage_tracker.record(self.model, completion.usage, scope, prompt_tokens)
+        self.last_usage = completion.usage
         content = completion.choices[0].message.content
         return content
 
-    def calc_tokens_for_msg(self, content: dict[str, str]):
-        """Calculate the number of tokens for a message."""
-        return num_tokens_from_message(content, self.model)
+    async def get_response_stream(
+        self,
+        message_list: list[dict[str, str]],
+        max_tokens: int = None,
+        temperature: float = 1,
+        prompt_tokens: int = None,
+        priority: int = PRIORITY_REPLY,
+        scope: RequestScope = None,
+        policy: CallPolicyConfig = None,
+    ) -> AsyncIterator[str]:
+        """Get a GPT completion for the current message history, yielding the text as it's generated.
+
+        The call policy applies to starting the stream, and its timeout also limits the wait for each chunk.
+        """
+        policy = policy or bot_config.openai.reply_policy
+        logger.debug(
+            "Requesting streamed response from ChatGPT with messages: %s",
+            message_list,
+            extra=scope.log_context(self.model) if scope else {"model": self.model},
+        )
+        if prompt_tokens is None:
+            prompt_tokens = await num_tokens_from_messages(message_list, self.model)
+
+        scheduler.in_flight += 1
+        try:
+            stream = await self._create(
+                {
+                    "messages": message_list,
+                    "max_tokens": max_tokens or bot_config.openai.reply_token_limit,
+                    "temperature": temperature,
+                    "stream": True,
+                    # Sends a final chunk with the usage for the whole response
+                    "stream_options": {"include_usage": True},
+                },
+                prompt_tokens,
+                priority,
+                scope,
+                policy,
+            )
+
+            async with stream:
+                chunks = aiter(stream)
+                while True:
+                    try:
+                        # Only the wait on OpenAI is timed, not whatever the caller does between chunks
+                        chunk = await asyncio.wait_for(anext(chunks), policy.timeout)
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        logger.warning(
+                            "Stream from %s stalled for %ss, giving up",
+                            self.model,
+                            policy.timeout,
+                        )
+                        raise
+
+                    if chunk.usage:
+                        usage_tracker.record(
+                            self.model, chunk.usage, scope, prompt_tokens
+                        )
+                        self.last_usage = chunk.usage
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        finally:
+            scheduler.in_flight -= 1
+
+    async def _create(
+        self,
+        request: dict,
+        prompt_tokens: int,
+        priority: int,
+        scope: Optional[RequestScope],
+        policy: CallPolicyConfig,
+    ):
+        """Send a completion request, retrying rate limits and transient errors."""
+        # OpenAI counts the requested completion size against the token budget too
+        budget_tokens = (
+            usage_tracker.calibrated(self.model, prompt_tokens) + request["max_tokens"]
+        )
+
+        rate_limited = 0
+        failures = 0
+        while True:
+            try:
+                return await self._send_hedged(
+                    request, budget_tokens, priority, scope, policy
+                )
+            except RateLimitError as e:
+                if (
+                    rate_limited >= bot_config.openai.rate_limit_retries
+                    or e.code == "insufficient_quota"
+                ):
+                    raise
+
+                delay = get_retry_after(e) or 2**rate_limited
+                rate_limited += 1
+                logger.warning(
+                    "Rate limited by OpenAI on %s, holding requests for %.1fs",
+                    self.model,
+                    delay,
+                )
+                scheduler.backoff(self.model, delay)
+            except RETRYABLE_ERRORS as e:
+                if failures >= policy.max_retries:
+                    raise
+
+                # Exponential backoff with jitter
+                delay = min(policy.backoff_max, policy.backoff_base * 2**failures)
+                delay *= random.uniform(0.5, 1)
+                failures += 1
+                logger.warning(
+                    "Retrying %s request in %.1fs after %s", self.model, delay, repr(e)
+                )
+                await asyncio.sleep(delay)
+
+    async def _send_hedged(
+        self,
+        request: dict,
+        budget_tokens: int,
+        priority: int,
+        scope: Optional[RequestScope],
+        policy: CallPolicyConfig,
+    ):
+        """Send a request, and if the policy allows, a second one when the first is slower than usual.
+        Whichever succeeds first wins and the other is cancelled."""
+        if not policy.hedge:
+            return await self._send(request, budget_tokens, priority, scope, policy)
+
+        granted = asyncio.Event()
+        first = asyncio.create_task(
+            self._send(
+                request, budget_tokens, priority, scope, policy, on_send=granted.set
+            )
+        )
+        tasks = {first}
+        winner = None
+        try:
+            # Only start the hedge timer once the first request has left the scheduler queue
+            granted_wait = asyncio.create_task(granted.wait())
+            try:
+                await asyncio.wait(
+                    {first, granted_wait}, return_when=asyncio.FIRST_COMPLETED
+                )
+            finally:
+                granted_wait.cancel()
+
+            p95 = model_router.tracker(self.model).percentile(95)
+            done, _ = await asyncio.wait(
+                tasks, timeout=max(policy.hedge_min_delay, p95 or 0)
+            )
+            if not done:
+                tasks.add(
+                    asyncio.create_task(
+                        self._send(
+                            request,
+                            budget_tokens,
+                            priority,
+                            scope,
+                            policy,
+                            on_send=self._count_hedge,
+                        )
+                    )
+                )
+
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if not task.exception():
+                        winner = task
+                        return task.result()
+
+            # Everything failed, report the original request's error
+            raise first.exception()
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif (
+                    request.get("stream")
+                    and not task.cancelled()
+                    and not task.exception()
+                ):
+                    # The losing stream already started, hang up on it
+                    await task.result().close()
+
+    def _count_hedge(self):
+        logger.debug("Hedging slow %s request", self.model)
+        hedge_stats[self.model] += 1
+
+    async def _send(
+        self,
+        request: dict,
+        budget_tokens: int,
+        priority: int,
+        scope: Optional[RequestScope],
+        policy: CallPolicyConfig,
+        on_send: Callable[[], None] = None,
+    ):
+        """Send one request once the scheduler allows it, calling on_send just before it goes out."""
+        await scheduler.acquire(
+            self.model, budget_tokens, priority, scope.thread_id if scope else None
+        )
+        if on_send:
+            on_send()
+
+        start = time.monotonic()
+        try:
+            completion = await asyncio.wait_for(
+                openai_client.chat.completions.create(model=self.model, **request),
+                policy.timeout,
+            )
+        except Exception as e:
+            model_router.record(self.model, time.monotonic() - start, False)
+            openai_errors.inc(self.model, self.call_type, type(e).__name__)
+            raise
+
+        # For streams this is the time until the response starts
+        model_router.record(self.model, time.monotonic() - start, True)
+        openai_request_seconds.observe(
+            time.monotonic() - start, self.model, self.call_type
+        )
+        return completion
+
+    async def calc_tokens_for_msgs(self, messages: list[dict[str, str]]):
+        """Calculate the number of tokens for each message in a list."""
+        return await num_tokens_for_each_message(messages, self.model)
 
     @property
     def token_limit(self):
         return bot_config.openai.thread_token_limit or AVAILABLE_MODELS[self.model]
 
 
-def num_tokens_from_message(message: dict[str, str], model):
-    """Return the number of tokens used by a list of messages."""
+def get_retry_after(e: RateLimitError) -> float | None:
+    """Get how long OpenAI asked us to wait before retrying, if it said."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.error("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in AVAILABLE_MODELS:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = tokens_per_message
-    for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
-        if key == "name":
-            num_tokens += tokens_per_name
-    return num_tokens
+        return float(e.response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
 
 
-def num_tokens_from_messages(messages: list[dict[str, str]], model):
-    """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.error("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+async def num_tokens_for_each_message(messages: list[dict[str, str]], model):
+    """Return the number of tokens used by each message in a list."""
     if model in AVAILABLE_MODELS:
         tokens_per_message = 3
         tokens_per_name = 1
@@ -105,12 +389,27 @@ def num_tokens_from_messages(messages: list[dict[str, str]], model):
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
-    num_tokens = 0
+
+    # Encode every value in one batch
+    lengths = iter(
+        await tokenizer.count(
+            [value for message in messages for value in message.values()], model
+        )
+    )
+
+    counts = []
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+        num_tokens = tokens_per_message
+        for key in message:
+            num_tokens += next(lengths)
             if key == "name":
                 num_tokens += tokens_per_name
+        counts.append(num_tokens)
+    return counts
+
+
+async def num_tokens_from_messages(messages: list[dict[str, str]], model):
+    """Return the number of tokens used by a list of messages."""
+    num_tokens = sum(await num_tokens_for_each_message(messages, model))
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
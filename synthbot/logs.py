@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import random
+from typing import Optional
+
+# Record attributes passed with extra= that are worth keeping as their own fields
+CONTEXT_FIELDS = ("thread_id", "message_id", "guild_id", "model")
+
+
+def truncate(text: str, max_length: Optional[int]) -> str:
+    """Cut off long text, noting how long it was and a hash of it so repeats can still be matched up."""
+    if not max_length or len(text) <= max_length:
+        return text
+    digest = hashlib.sha256(text.encode()).hexdigest()[:12]
+    return f"{text[:max_length]}… [{len(text)} chars, sha256 {digest}]"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queues records as they are, so formatting them happens on the listener thread instead of the caller's."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a share of the debug records from some loggers.
+
+    Rates apply to a logger and everything under it, with the most specific name winning.
+    """
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._cache: dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        if name not in self._cache:
+            rate = 1.0
+            prefix = name
+            while prefix:
+                if prefix in self.rates:
+                    rate = self.rates[prefix]
+                    break
+                prefix = prefix.rpartition(".")[0]
+            self._cache[name] = rate
+        return self._cache[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.INFO or not self.rates:
+            return True
+        return random.random() < self._rate(record.name)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, fmt: str, datefmt: str, max_length: Optional[int]):
+        super().__init__(fmt, datefmt, style="{")
+        self.max_length = max_length
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = truncate(record.message, self.max_length)
+        return super().formatMessage(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def __init__(self, max_length: Optional[int]):
+        super().__init__()
+        self.max_length = max_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(record.getMessage(), self.max_length),
+        }
+        for field in CONTEXT_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
@@ -0,0 +1,223 @@
+from abc import ABC, abstractmethod
+from aiohttp import web
+from bisect import bisect_left
+from contextlib import contextmanager
+import logging
+import time
+from typing import Callable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# label values -> value
+Samples = dict[tuple[str, ...], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+    return (
+        "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+    )
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self._render_samples()
+
+    @abstractmethod
+    def _render_samples(self) -> Iterator[str]:
+        """Get the sample lines for this metric."""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    values: Samples
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        super().__init__(name, help, label_names)
+        self.values = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def _render_samples(self):
+        for values, value in self.values.items():
+            yield f"{self.name}{_labels(self.label_names, values)} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    # label values -> (count per bucket, sum, count)
+    values: dict[tuple[str, ...], tuple[list[int], float, int]]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, label_names)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, *label_values: str):
+        counts, total, count = self.values.get(
+            label_values, ([0] * len(self.buckets), 0.0, 0)
+        )
+        index = bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        self.values[label_values] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, *label_values: str):
+        """Observe how long the block takes, whether or not it succeeds."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, *label_values)
+
+    def _render_samples(self):
+        for values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_labels(self.label_names, values, le=str(bucket))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(self.label_names, values, le='+Inf')} {count}"
+            yield f"{self.name}_sum{_labels(self.label_names, values)} {total}"
+            yield f"{self.name}_count{_labels(self.label_names, values)} {count}"
+
+
+class Collected(Metric):
+    """Values read from somewhere else each time metrics are scraped."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        label_names: tuple[str, ...],
+        collect: Callable[[], Samples],
+    ):
+        super().__init__(name, help, label_names)
+        self.type = type
+        self.collect = collect
+
+    def _render_samples(self):
+        for values, value in self.collect().items():
+            yield f"{self.name}{_labels(self.label_names, values)} {value}"
+
+
+class MetricsRegistry:
+    metrics: dict[str, Metric]
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric: Metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, help: str, label_names: tuple[str, ...] = ()
+    ) -> Counter:
+        return self._add(Counter(name, help, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._add(Histogram(name, help, label_names, buckets))
+
+    def collect(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        label_names: tuple[str, ...],
+        collect: Callable[[], Samples],
+    ) -> Collected:
+        return self._add(Collected(name, help, type, label_names, collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(list(metric.render()))
+            except Exception:
+                logger.exception("Failed to collect metric %s", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the registry in the Prometheus text format at /metrics."""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info("Serving metrics on %s:%d", host, port)
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = MetricsRegistry()
+
+reply_stage_seconds = metrics.histogram(
+    "synthbot_reply_stage_seconds",
+    "Time spent in each stage of replying to a thread",
+    ("stage",),
+)
+openai_request_seconds = metrics.histogram(
+    "synthbot_openai_request_seconds",
+    "Time until OpenAI responded, or started streaming",
+    ("model", "call_type"),
+)
+openai_errors = metrics.counter(
+    "synthbot_openai_errors_total",
+    "Failed OpenAI requests",
+    ("model", "call_type", "error"),
+)
+reply_errors = metrics.counter(
+    "synthbot_reply_errors_total",
+    "Replies that failed and posted an error instead",
+    ("error",),
+)
@@ -0,0 +1,138 @@
+import asyncio
+from collections import Counter
+import logging
+import os
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Innermost frames that mean the loop was waiting for something to do
+IDLE_FRAMES = {
+    ("select", "selectors.py"),
+    ("poll", "selectors.py"),
+    ("control", "selectors.py"),
+}
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    path = code.co_filename.split(os.sep)
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from a background thread, so it can run in production.
+
+    Each sample also notes which task was running, so time can be attributed to coroutines and not just the
+    event loop machinery under them."""
+
+    # Stacks as labels, outermost first -> samples
+    stacks: Counter[tuple[str, ...]]
+    # Coroutine name -> samples
+    tasks: Counter[str]
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.tasks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def start(self, seconds: float):
+        """Start profiling the running event loop for up to this many seconds, or until stopped."""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample,
+            args=(asyncio.get_running_loop(), threading.get_ident(), seconds),
+            name="profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    async def wait(self) -> str:
+        """Wait for profiling to finish and get the report."""
+        await asyncio.to_thread(self._thread.join)
+        return self.report()
+
+    def stop(self):
+        self._stop.set()
+
+    def _sample(self, loop: asyncio.AbstractEventLoop, thread_id: int, seconds: float):
+        """Runs on the profiler thread."""
+        self.stacks.clear()
+        self.tasks.clear()
+        self.samples = 0
+        self.idle = 0
+
+        start = time.monotonic()
+        while not self._stop.wait(self.interval) and time.monotonic() - start < seconds:
+            frame = sys._current_frames().get(thread_id)
+            if not frame:
+                continue
+
+            self.samples += 1
+            if (
+                frame.f_code.co_name,
+                os.path.basename(frame.f_code.co_filename),
+            ) in IDLE_FRAMES:
+                self.idle += 1
+                continue
+
+            stack = []
+            while frame:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+            # Not thread safe, but it's only read
+            task = asyncio.current_task(loop)
+            self.tasks[task.get_coro().__qualname__ if task else "(callbacks)"] += 1
+
+        self.duration = time.monotonic() - start
+
+    def report(self, top: int = 30) -> str:
+        busy = self.samples - self.idle
+        lines = [
+            (
+                f"{self.samples} samples over {self.duration:.1f}s, loop busy {busy / self.samples:.1%}"
+                if self.samples
+                else "No samples"
+            ),
+            "",
+        ]
+
+        own: Counter[str] = Counter()
+        total: Counter[str] = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+
+        def table(title: str, counts: Counter[str]):
+            lines.append(f"{title}:")
+            for label, count in counts.most_common(top):
+                lines.append(f"{count / busy:7.1%} {count:7d}  {label}")
+            lines.append("")
+
+        if busy:
+            table("Running tasks", self.tasks)
+            table("Own time", own)
+            table("Total time", total)
+
+        # Collapsed stacks, which flame graph tools can read directly
+        lines.append("Stacks:")
+        for stack, count in self.stacks.most_common():
+            lines.append(f"{';'.join(stack)} {count}")
+
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Awaitable, Callable
+
+from .cache import MISSING, SqliteStore, TTLCache
+from .config import bot_config
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Completion text keyed by a hash of everything that went into the request.
+
+    Identical requests made while one is already in flight wait for that one instead of going upstream.
+    """
+
+    _in_flight: dict[str, asyncio.Task[str]]
+
+    def __init__(self, cache: TTLCache):
+        self.cache = cache
+        self._in_flight = {}
+        self.coalesced = 0
+
+    @staticmethod
+    def key(
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        message_list: list[dict[str, str]],
+    ) -> str:
+        data = json.dumps(
+            [model, temperature, max_tokens, message_list],
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    async def get_or_create(
+        self, key: str, create: Callable[[], Awaitable[str]]
+    ) -> str:
+        """Get a cached response, or call create to make one."""
+        cached = self.cache.get(key)
+        if cached is not MISSING:
+            return cached
+
+        task = self._in_flight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            task = asyncio.create_task(create())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+
+        # Shielded so a caller giving up doesn't cancel the request for everyone else
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task[str]):
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and not task.exception() and task.result():
+            self.cache.set(key, task.result())
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {**self.cache.stats, "coalesced": self.coalesced}
+
+
+response_cache = ResponseCache(
+    TTLCache(
+        bot_config.openai.response_cache_size,
+        bot_config.openai.response_cache_ttl,
+        store=(
+            SqliteStore(bot_config.openai.response_cache_path, "responses")
+            if bot_config.openai.response_cache_path
+            else None
+        ),
+    )
+)
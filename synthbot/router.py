@@ -0,0 +1,141 @@
+from collections import Counter, deque
+import logging
+import time
+from typing import Optional
+
+from .config import bot_config
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Recent call latencies and outcomes for one model, over a rolling time window."""
+
+    # (finished at, seconds taken, succeeded)
+    samples: deque[tuple[float, float, bool]]
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self.samples = deque()
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+
+    def record(self, latency: float, ok: bool):
+        self.samples.append((time.monotonic(), latency, ok))
+        self._expire()
+
+    def __len__(self):
+        self._expire()
+        return len(self.samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Latency percentile (0-100) of successful calls, or None without any."""
+        self._expire()
+        latencies = sorted(latency for _, latency, ok in self.samples if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    @property
+    def error_rate(self) -> float:
+        self._expire()
+        if not self.samples:
+            return 0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+
+class ModelRouter:
+    """Picks between a primary model and its fallbacks based on prompt size and how the models have been behaving.
+
+    A model is skipped while its recent p95 latency is over the SLO or too many of its recent calls failed. Samples
+    age out of the window, so a skipped model gets traffic again once it's been left alone for a while.
+    """
+
+    trackers: dict[str, LatencyTracker]
+    # (primary, chosen, reason) -> count
+    decisions: Counter[tuple[str, str, str]]
+
+    def __init__(self, context_limits: dict[str, int]):
+        self.context_limits = context_limits
+        self.trackers = {}
+        self.decisions = Counter()
+
+    def tracker(self, model: str) -> LatencyTracker:
+        if model not in self.trackers:
+            self.trackers[model] = LatencyTracker(
+                bot_config.openai.router_window_seconds
+            )
+        return self.trackers[model]
+
+    def record(self, model: str, latency: float, ok: bool):
+        self.tracker(model).record(latency, ok)
+
+    def _unhealthy_reason(self, model: str, prompt_tokens: int) -> Optional[str]:
+        if model not in self.context_limits:
+            return "unknown_model"
+        if prompt_tokens > self.context_limits[model]:
+            return "prompt_too_large"
+
+        tracker = self.tracker(model)
+        if len(tracker) < bot_config.openai.router_min_samples:
+            # Not enough data to judge, assume it's fine
+            return None
+        if tracker.error_rate > bot_config.openai.router_max_error_rate:
+            return "error_rate"
+        p95 = tracker.percentile(95)
+        if (
+            bot_config.openai.latency_slo
+            and p95
+            and p95 > bot_config.openai.latency_slo
+        ):
+            return "slow"
+        return None
+
+    def choose(self, primary: str, prompt_tokens: int) -> str:
+        """Get the model to send a request to."""
+        reasons = []
+        for model in [primary, *bot_config.openai.fallback_models]:
+            reason = self._unhealthy_reason(model, prompt_tokens)
+            if not reason:
+                break
+            reasons.append(f"{model}: {reason}")
+        else:
+            # Nothing looks healthy, stick with what was asked for
+            model = primary
+
+        decision_reason = reasons[0].split(": ")[1] if reasons else "primary"
+        self.decisions[(primary, model, decision_reason)] += 1
+        if model != primary or reasons:
+            logger.info(
+                "Routed %d token request for %s to %s (%s)",
+                prompt_tokens,
+                primary,
+                model,
+                ", ".join(reasons),
+            )
+        else:
+            logger.debug("Routed %d token request to %s", prompt_tokens, model)
+
+        return model
+
+    @property
+    def decision_stats(self) -> dict[str, int]:
+        return {
+            f"{primary} -> {chosen} ({reason})": count
+            for (primary, chosen, reason), count in self.decisions.items()
+        }
+
+    @property
+    def stats(self) -> dict[str, dict[str, float | int | None]]:
+        return {
+            model: {
+                "samples": len(tracker),
+                "p50": tracker.percentile(50),
+                "p95": tracker.percentile(95),
+                "error_rate": tracker.error_rate,
+            }
+            for model, tracker in self.trackers.items()
+        }
@@ -0,0 +1,218 @@
+import asyncio
+from collections import OrderedDict, deque
+import logging
+import time
+from typing import Hashable, Optional
+
+from .config import RateLimitConfig, bot_config
+
+logger = logging.getLogger(__name__)
+
+# Lower numbers go first
+PRIORITY_REPLY = 0
+PRIORITY_SUMMARY = 1
+
+
+class TokenBucket:
+    """Allows up to capacity units per minute, refilling continuously."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: int) -> float:
+        """Seconds until amount is available."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return max(0, (amount - self.level) / self.rate)
+
+    def consume(self, amount: int):
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+
+class ModelBudget:
+    """Requests per minute and tokens per minute budgets for one model."""
+
+    def __init__(self, limits: RateLimitConfig):
+        self.requests = (
+            TokenBucket(limits.requests_per_minute)
+            if limits.requests_per_minute
+            else None
+        )
+        self.tokens = (
+            TokenBucket(limits.tokens_per_minute) if limits.tokens_per_minute else None
+        )
+        # Set when OpenAI tells us to slow down
+        self.paused_until = 0.0
+
+    def time_until(self, tokens: int) -> float:
+        wait = max(0, self.paused_until - time.monotonic())
+        if self.requests:
+            wait = max(wait, self.requests.time_until(1))
+        if self.tokens:
+            wait = max(wait, self.tokens.time_until(tokens))
+        return wait
+
+    def consume(self, tokens: int):
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(tokens)
+
+
+class _Request:
+    def __init__(self, model: str, tokens: int, future: asyncio.Future):
+        self.model = model
+        self.tokens = tokens
+        self.future = future
+
+
+class RequestScheduler:
+    """Queues OpenAI requests and starts them as each model's rate budget allows.
+
+    Higher priority requests go first. Within a priority, callers with different keys (threads) take turns, so
+    one busy thread can't starve the rest. Callers wait in the queue instead of getting rate limit errors.
+    """
+
+    # priority -> key -> waiting requests
+    _queues: dict[int, OrderedDict[Hashable, deque[_Request]]]
+    _budgets: dict[str, Optional[ModelBudget]]
+
+    def __init__(self):
+        self._queues = {}
+        self._budgets = {}
+        self._wakeup = None
+        self._dispatcher = None
+        self.in_flight = 0
+
+    def _budget(self, model: str) -> Optional[ModelBudget]:
+        if model not in self._budgets:
+            limits = bot_config.openai.rate_limits.get(model)
+            self._budgets[model] = ModelBudget(limits) if limits else None
+        return self._budgets[model]
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(
+            len(requests)
+            for queue in self._queues.values()
+            for requests in queue.values()
+        )
+
+    async def acquire(
+        self,
+        model: str,
+        tokens: int,
+        priority: int = PRIORITY_REPLY,
+        key: Hashable = None,
+    ):
+        """Wait until a request of this many tokens can be sent to the model."""
+        budget = self._budget(model)
+        if not budget:
+            return
+
+        if not self.queue_depth and not budget.time_until(tokens):
+            # Nothing ahead of us and the budget is there
+            budget.consume(tokens)
+            return
+
+        loop = asyncio.get_running_loop()
+        request = _Request(model, tokens, loop.create_future())
+        self._queues.setdefault(priority, OrderedDict()).setdefault(
+            key, deque()
+        ).append(request)
+        self._wake()
+
+        try:
+            await request.future
+        finally:
+            if not request.future.done():
+                # We gave up waiting
+                request.future.cancel()
+                self._wake()
+
+    def backoff(self, model: str, delay: float):
+        """Hold all requests for a model after OpenAI rate limited us."""
+        budget = self._budget(model)
+        if not budget:
+            # No configured limits, but we still need somewhere to keep the pause
+            budget = self._budgets[model] = ModelBudget(RateLimitConfig())
+        budget.paused_until = max(budget.paused_until, time.monotonic() + delay)
+
+    def _wake(self):
+        if not self._wakeup:
+            self._wakeup = asyncio.Event()
+        if not self._dispatcher or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            wait = self._grant_ready()
+            if wait is None:
+                # Queue is empty
+                self._dispatcher = None
+                return
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant_ready(self) -> Optional[float]:
+        """Start every request that fits its budget. Returns how long until the next one might, or None if
+        nothing is waiting."""
+        while True:
+            granted = False
+            next_wait = None
+            # Models with a request already waiting, so smaller requests behind it can't starve it
+            blocked: set[str] = set()
+
+            for priority in sorted(self._queues):
+                queue = self._queues[priority]
+                for key in list(queue):
+                    requests = queue[key]
+                    while requests and requests[0].future.done():
+                        requests.popleft()
+                    if not requests:
+                        del queue[key]
+                        continue
+
+                    request = requests[0]
+                    if request.model in blocked:
+                        continue
+
+                    budget = self._budget(request.model)
+                    wait = budget.time_until(request.tokens)
+                    if wait:
+                        blocked.add(request.model)
+                        next_wait = wait if next_wait is None else min(next_wait, wait)
+                        continue
+
+                    budget.consume(request.tokens)
+                    request.future.set_result(None)
+                    requests.popleft()
+                    # Send this key to the back of the line
+                    queue.move_to_end(key)
+                    granted = True
+                    break
+
+                if granted:
+                    break
+                if not queue:
+                    del self._queues[priority]
+
+            if not granted:
+                return next_wait
+
+
+scheduler = RequestScheduler()
@@ -1,15 +1,41 @@
+import aiohttp
+import asyncio
+import cattrs
 from typing import Optional
 from discord import Embed
 import re
-import requests
 import logging
 
+from ..cache import MISSING, SqliteStore, TTLCache
+from ..config import bot_config
+from .bulk import BulkCardIndex
+from .client import ScryfallNotFoundError, scryfall_client
 from .types import ScryfallCard
 
 logger = logging.getLogger(__name__)
 
-# Keep a cache of cards fetched just to be safe
-CARD_CACHE: dict[str, ScryfallCard] = {}
+# Keep a cache of cards fetched just to be safe. Names Scryfall couldn't find are cached as None.
+CARD_CACHE = TTLCache(
+    bot_config.scryfall.cache_size,
+    bot_config.scryfall.cache_ttl,
+    store=(
+        SqliteStore(
+            bot_config.scryfall.cache_path,
+            "cards",
+            serialize=lambda card: cattrs.unstructure(card) if card else None,
+            deserialize=lambda data: ScryfallCard.from_json(data) if data else None,
+        )
+        if bot_config.scryfall.cache_path
+        else None
+    ),
+)
+
+# Offline card index, when configured
+BULK_INDEX = (
+    BulkCardIndex(bot_config.scryfall.bulk_data_path)
+    if bot_config.scryfall.bulk_data_path
+    else None
+)
 
 
 async def get_mtg_embeds_from_message(message: str) -> Optional[list[Embed]]:
@@ -21,15 +47,15 @@ async def get_mtg_embeds_from_message(message: str) -> Optional[list[Embed]]:
     if len(matches) < 1:
         return None
 
-    results = []
-    for card_name in matches:
-        if len(results) > 9:
-            # Only return the first 10 results
-            break
+    # Only look up the first 10 distinct cards, all at once
+    card_names = list({m.lower(): m for m in matches}.values())[:10]
+    cards = await resolve_cards(card_names)
 
-        embed = await get_mtg_embed_for_card_name(card_name)
-        if embed:
-            results.append(embed)
+    results = [
+        get_mtg_embed_for_card(cards[card_name.lower()])
+        for card_name in card_names
+        if cards[card_name.lower()]
+    ]
 
     if len(results) < 1:
         return None
@@ -39,21 +65,87 @@ async def get_mtg_embeds_from_message(message: str) -> Optional[list[Embed]]:
 
 async def get_mtg_embed_for_card_name(card_name: str) -> Optional[Embed]:
     """Search for and return a Discord embed for an MTG card by name."""
-    if card_name.lower() in CARD_CACHE:
-        # Pull the card from the cache
-        card = CARD_CACHE[card_name.lower()]
-    else:
-        # Search for the card
-        try:
-            card = await get_card_by_fuzzy_match(card_name)
-        except requests.exceptions.HTTPError as e:
-            logger.exception("Got error while looking up [[%s]]", card_name)
-            return None
-
-        # Cache both the fuzzy name and the real name
-        CARD_CACHE[card_name.lower()] = card
-        CARD_CACHE[card.name.lower()] = card
+    card = (await resolve_cards([card_name]))[card_name.lower()]
+    return get_mtg_embed_for_card(card) if card else None
+
+
+async def resolve_cards(card_names: list[str]) -> dict[str, Optional[ScryfallCard]]:
+    """Look up MTG cards by name, keyed by the lowercase name. Cards that can't be found are None.
+
+    Uncached names are looked up by exact name in one batch, then by fuzzy name for the rest.
+    """
+    results: dict[str, Optional[ScryfallCard]] = {}
+
+    if BULK_INDEX and BULK_INDEX.loaded:
+        # Search the local bulk data only
+        names = {card_name.lower(): card_name for card_name in card_names}
+        cards = await BULK_INDEX.lookup_many(list(names.values()))
+        return dict(zip(names.keys(), cards))
+
+    uncached: dict[str, str] = {}
+    for card_name in card_names:
+        key = card_name.lower()
+        if key in results or key in uncached:
+            continue
+
+        card = CARD_CACHE.get(key)
+        if card is MISSING:
+            uncached[key] = card_name
+        else:
+            results[key] = card
+
+    if not uncached:
+        return results
+
+    # Try the names exactly as written first, all in one request
+    try:
+        cards = await scryfall_client.get_cards_by_exact_names(list(uncached.values()))
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.exception("Got error while looking up %s", list(uncached.values()))
+        cards = []
+
+    for card in cards:
+        # Multi-faced cards can be asked for by either face
+        for key in [card.name.lower(), *card.name.lower().split(" // ")]:
+            if key in uncached:
+                results[key] = card
+                CARD_CACHE.set(key, card)
+                del uncached[key]
+        CARD_CACHE.set(card.name.lower(), card)
+
+    # Fall back to a fuzzy search for anything that wasn't an exact name
+    fuzzy_cards = await asyncio.gather(
+        *(get_card_by_fuzzy_match(card_name) for card_name in uncached.values())
+    )
+    for key, card in zip(uncached.keys(), fuzzy_cards):
+        if card is MISSING:
+            # Lookup failed, try again next time
+            results[key] = None
+        elif card is None:
+            results[key] = None
+            CARD_CACHE.set(key, None, ttl=bot_config.scryfall.negative_cache_ttl)
+        else:
+            # Cache both the fuzzy name and the real name
+            results[key] = card
+            CARD_CACHE.set(key, card)
+            CARD_CACHE.set(card.name.lower(), card)
+
+    return results
+
+
+async def get_card_by_fuzzy_match(card_name: str) -> Optional[ScryfallCard]:
+    try:
+        return await scryfall_client.get_card_by_fuzzy_match(card_name)
+    except ScryfallNotFoundError:
+        logger.info("Scryfall couldn't find a card named [[%s]]", card_name)
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.exception("Got error while looking up [[%s]]", card_name)
+        return MISSING
+
 
+def get_mtg_embed_for_card(card: ScryfallCard) -> Embed:
+    """Build a Discord embed for an MTG card."""
     em = Embed(title=f"{card.name} {card.mana_cost}", url=card.scryfall_uri)
     em.add_field(name="Type", value=card.type_line, inline=False).add_field(
         name="Oracle text", value=card.oracle_text, inline=False
@@ -71,16 +163,3 @@ async def get_mtg_embed_for_card_name(card_name: str) -> Optional[Embed]:
         em.set_thumbnail(url=card.image_uris["normal"])
 
     return em
-
-
-async def get_card_by_fuzzy_match(card_name: str) -> ScryfallCard:
-    logger.debug("Looking up on Scryfall for a card named [[%s]]", card_name)
-
-    req = requests.get(
-        "https://api.scryfall.com/cards/named", params={"fuzzy": card_name}
-    )
-    req.raise_for_status()
-
-    res = req.json()
-    card = ScryfallCard.from_json(res)
-    return card
@@ -0,0 +1,234 @@
+from array import array
+import asyncio
+from collections import Counter
+import json
+import logging
+import os
+import re
+import time
+from typing import IO, Iterator, Optional
+import unicodedata
+
+from .types import ScryfallCard
+
+logger = logging.getLogger(__name__)
+
+# Layouts that share names with real cards but aren't what anyone means by [[name]]
+SKIPPED_LAYOUTS = {"token", "double_faced_token", "emblem", "art_series"}
+
+# Minimum trigram similarity for a fuzzy match
+MIN_FUZZY_SCORE = 0.5
+
+
+def iter_json_array(f: IO[str], chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """Yield each element of a top level JSON array without reading the whole file into memory."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip past whitespace, the opening bracket and separators
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+            pos += 1
+        if pos < len(buffer) and not started:
+            if buffer[pos] != "[":
+                raise ValueError("Bulk data file is not a JSON array")
+            started = True
+            pos += 1
+            continue
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        if pos < len(buffer):
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+                yield obj
+                continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+
+        if eof:
+            raise ValueError("Bulk data file ended before the JSON array was closed")
+
+        # Need more data
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def normalize_name(name: str) -> str:
+    """Normalize a card name for matching: no accents, punctuation, case or extra spaces."""
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    name = re.sub(r"[^a-z0-9 ]", "", name.lower())
+    return " ".join(name.split())
+
+
+def trigrams(name: str) -> set[str]:
+    padded = f"  {name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class CardIndex:
+    """In-memory card lookup built from a Scryfall bulk data dump, with a trigram index for fuzzy names."""
+
+    cards: list[ScryfallCard]
+    # Normalized name (full name and each face) -> card index
+    names: dict[str, int]
+    # Parallel arrays over every indexed name
+    _name_cards: array
+    _name_trigram_counts: array
+    # Trigram -> indexes into the name arrays
+    _trigrams: dict[str, array]
+
+    def __init__(self):
+        self.cards = []
+        self.names = {}
+        self._name_cards = array("I")
+        self._name_trigram_counts = array("H")
+        self._trigrams = {}
+
+    def __len__(self):
+        return len(self.cards)
+
+    @classmethod
+    def from_file(cls, path: str) -> "CardIndex":
+        """Build an index from a bulk data JSON file. This is slow, so run it off the event loop."""
+        index = cls()
+        with open(path, "r", encoding="utf-8") as f:
+            for data in iter_json_array(f):
+                if data.get("layout") in SKIPPED_LAYOUTS:
+                    continue
+                index._add(data)
+
+        # Freeze the trigram lists into compact arrays
+        index._trigrams = {
+            trigram: array("I", ids) for trigram, ids in index._trigrams.items()
+        }
+        return index
+
+    def _add(self, data: dict):
+        names = [data["name"]]
+        if " // " in data["name"]:
+            names.extend(data["name"].split(" // "))
+
+        keys = [
+            key for key in map(normalize_name, names) if key and key not in self.names
+        ]
+        if normalize_name(data["name"]) not in keys:
+            # Another printing of a card we already have
+            return
+
+        card_id = len(self.cards)
+        self.cards.append(ScryfallCard.from_json(data))
+
+        for key in keys:
+            self.names[key] = card_id
+            name_id = len(self._name_cards)
+            key_trigrams = trigrams(key)
+            self._name_cards.append(card_id)
+            self._name_trigram_counts.append(min(len(key_trigrams), 0xFFFF))
+            for trigram in key_trigrams:
+                self._trigrams.setdefault(trigram, []).append(name_id)
+
+    def exact_lookup(self, card_name: str) -> Optional[ScryfallCard]:
+        key = normalize_name(card_name)
+        return self.cards[self.names[key]] if key in self.names else None
+
+    def fuzzy_lookup(self, key: str) -> Optional[ScryfallCard]:
+        """Find the card with the closest name to an already normalized name. Slow enough to keep off the
+        event loop."""
+        if not key:
+            return None
+
+        # Score every name sharing a trigram with the query by Dice coefficient
+        query_trigrams = trigrams(key)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self._trigrams.get(trigram, ()))
+        if not shared:
+            return None
+
+        best_score, best_name = max(
+            (
+                2 * count / (len(query_trigrams) + self._name_trigram_counts[name_id]),
+                name_id,
+            )
+            for name_id, count in shared.items()
+        )
+        if best_score < MIN_FUZZY_SCORE:
+            return None
+
+        return self.cards[self._name_cards[best_name]]
+
+
+class BulkCardIndex:
+    """Holds the current CardIndex and rebuilds it in the background when the dump changes."""
+
+    index: Optional[CardIndex]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = None
+        self._mtime = None
+        self._reload_task = None
+
+    @property
+    def loaded(self):
+        return self.index is not None
+
+    async def lookup_many(self, card_names: list[str]) -> list[Optional[ScryfallCard]]:
+        """Look up several cards, doing any fuzzy matching on a worker thread."""
+        index = self.index
+        if not index:
+            return [None] * len(card_names)
+
+        results = [index.exact_lookup(card_name) for card_name in card_names]
+        misses = [i for i, card in enumerate(results) if card is None]
+        if misses:
+            fuzzy = await asyncio.to_thread(
+                lambda: [
+                    index.fuzzy_lookup(normalize_name(card_names[i])) for i in misses
+                ]
+            )
+            for i, card in zip(misses, fuzzy):
+                results[i] = card
+        return results
+
+    async def reload(self, force: bool = False):
+        """Rebuild the index on a worker thread and swap it in once it's ready."""
+        mtime = os.path.getmtime(self.path)
+        if not force and mtime == self._mtime:
+            return
+
+        start = time.monotonic()
+        index = await asyncio.to_thread(CardIndex.from_file, self.path)
+        self.index = index
+        self._mtime = mtime
+        logger.info(
+            "Loaded %d cards from Scryfall bulk data %s in %.1fs",
+            len(index),
+            self.path,
+            time.monotonic() - start,
+        )
+
+    async def _reload_loop(self, interval: float):
+        while True:
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Failed to load Scryfall bulk data from %s", self.path)
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float):
+        """Load the index now and check the dump for changes every interval seconds."""
+        if not self._reload_task:
+            self._reload_task = asyncio.create_task(self._reload_loop(interval))
+
+    def stop(self):
+        if self._reload_task:
+            self._reload_task.cancel()
+            self._reload_task = None
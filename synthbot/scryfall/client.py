@@ -0,0 +1,113 @@
+import aiohttp
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from ..config import bot_config
+from .types import ScryfallCard
+
+logger = logging.getLogger(__name__)
+
+SCRYFALL_API = "https://api.scryfall.com"
+
+# Most identifiers /cards/collection accepts in one request
+COLLECTION_BATCH_SIZE = 75
+
+
+class ScryfallNotFoundError(Exception):
+    """Scryfall couldn't find (or couldn't pick) a card for the query."""
+
+
+class RateLimiter:
+    """Space out requests so they start no faster than the given rate."""
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._next_slot = 0.0
+
+    async def wait(self):
+        # Reserve the next free slot before sleeping so concurrent callers queue up behind each other
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class ScryfallClient:
+    """Async Scryfall API client with a persistent keep-alive connection pool."""
+
+    _session: Optional[aiohttp.ClientSession]
+
+    def __init__(self):
+        self._session = None
+        self.rate_limiter = RateLimiter(bot_config.scryfall.requests_per_second)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if not self._session or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                base_url=SCRYFALL_API,
+                connector=aiohttp.TCPConnector(
+                    limit=bot_config.scryfall.max_connections,
+                    keepalive_timeout=60,
+                ),
+                timeout=aiohttp.ClientTimeout(total=bot_config.scryfall.timeout),
+                # Scryfall requires these on every request
+                headers={
+                    "User-Agent": "synthgen-bot/1.0",
+                    "Accept": "application/json",
+                },
+                raise_for_status=False,
+            )
+        return self._session
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def get_card_by_fuzzy_match(self, card_name: str) -> ScryfallCard:
+        logger.debug("Looking up on Scryfall for a card named [[%s]]", card_name)
+
+        await self.rate_limiter.wait()
+        async with self.session.get(
+            "/cards/named", params={"fuzzy": card_name}
+        ) as resp:
+            if resp.status == 404:
+                raise ScryfallNotFoundError(card_name)
+            resp.raise_for_status()
+            res = await resp.json()
+
+        return ScryfallCard.from_json(res)
+
+    async def get_cards_by_exact_names(
+        self, card_names: list[str]
+    ) -> list[ScryfallCard]:
+        """Look up cards by their exact names in as few requests as possible, returning the ones that were found."""
+        batches = [
+            card_names[i : i + COLLECTION_BATCH_SIZE]
+            for i in range(0, len(card_names), COLLECTION_BATCH_SIZE)
+        ]
+        results = await asyncio.gather(
+            *(self._get_collection(batch) for batch in batches)
+        )
+
+        return [card for batch_cards in results for card in batch_cards]
+
+    async def _get_collection(self, card_names: list[str]) -> list[ScryfallCard]:
+        logger.debug("Looking up on Scryfall for cards named %s", card_names)
+
+        await self.rate_limiter.wait()
+        async with self.session.post(
+            "/cards/collection",
+            json={"identifiers": [{"name": name} for name in card_names]},
+        ) as resp:
+            resp.raise_for_status()
+            res = await resp.json()
+
+        return [ScryfallCard.from_json(data) for data in res["data"]]
+
+
+scryfall_client = ScryfallClient()
@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Imported first thing, so this is close to when the process started
+STARTED_AT = time.monotonic()
+
+# stage name -> seconds taken
+startup_timings: dict[str, float] = {}
+
+
+@contextmanager
+def startup_stage(name: str):
+    """Time one stage of starting up."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.monotonic() - start
+        logger.debug("Startup stage %s took %.2fs", name, startup_timings[name])
+
+
+def since_start() -> float:
+    return time.monotonic() - STARTED_AT
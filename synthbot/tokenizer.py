@@ -0,0 +1,149 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+from typing import Iterable
+
+import tiktoken
+
+from .config import bot_config
+
+logger = logging.getLogger(__name__)
+
+
+class TokenizerService:
+    """Count tokens on worker threads so encoding never blocks the event loop.
+
+    Requests for the same model made in the same loop iteration are encoded together as one batch.
+    """
+
+    _encodings: dict[str, tiktoken.Encoding]
+    _pending: dict[str, list[tuple[list[str], asyncio.Future]]]
+
+    def __init__(
+        self, max_workers: int = 2, batch_threads: int = 4, cache_dir: str = None
+    ):
+        if cache_dir:
+            # tiktoken looks for its encoding files here before downloading them
+            os.environ["TIKTOKEN_CACHE_DIR"] = cache_dir
+
+        self.max_workers = max_workers
+        self.batch_threads = batch_threads
+        self._encodings = {}
+        self._encodings_lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="tokenizer"
+            )
+        return self._executor
+
+    def _get_encoding(self, model: str) -> tiktoken.Encoding:
+        """Get the encoding for a model, loading it the first time. Runs on a worker thread."""
+        with self._encodings_lock:
+            if model in self._encodings:
+                return self._encodings[model]
+
+            try:
+                encoding = tiktoken.encoding_for_model(model)
+            except KeyError:
+                logger.error("Warning: model not found. Using cl100k_base encoding.")
+                encoding = tiktoken.get_encoding("cl100k_base")
+
+            self._encodings[model] = encoding
+            return encoding
+
+    async def get_encoding(self, model: str) -> tiktoken.Encoding:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._get_encoding, model)
+
+    async def warmup(self, models: Iterable[str]):
+        """Load the encodings for these models ahead of their first use."""
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(self.executor, self._get_encoding, model)
+                for model in set(models)
+            ),
+            return_exceptions=True,
+        )
+        for error in results:
+            if isinstance(error, Exception):
+                logger.error("Failed to load a tokenizer encoding", exc_info=error)
+
+    def _encode_lengths(self, model: str, texts: list[str]) -> list[int]:
+        """Get the token length of each text. Runs on a worker thread."""
+        encoding = self._get_encoding(model)
+        if len(texts) == 1:
+            return [len(encoding.encode_ordinary(texts[0]))]
+
+        return [
+            len(tokens)
+            for tokens in encoding.encode_ordinary_batch(
+                texts, num_threads=self.batch_threads
+            )
+        ]
+
+    async def count(self, texts: list[str], model: str) -> list[int]:
+        """Get the number of tokens in each text."""
+        if not texts:
+            return []
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        if model not in self._pending:
+            # First request for this model this iteration, flush once everyone else has queued up
+            self._pending[model] = []
+            loop.call_soon(self._flush, model)
+        self._pending[model].append((texts, future))
+
+        return await future
+
+    def _flush(self, model: str):
+        batch = self._pending.pop(model, [])
+        if not batch:
+            return
+
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        logger.debug(
+            "Encoding %d texts for %d requests with model %s",
+            len(texts),
+            len(batch),
+            model,
+        )
+
+        job = asyncio.wrap_future(
+            self.executor.submit(self._encode_lengths, model, texts)
+        )
+        job.add_done_callback(lambda j: self._resolve(batch, j))
+
+    def _resolve(
+        self, batch: list[tuple[list[str], asyncio.Future]], job: asyncio.Future
+    ):
+        error = asyncio.CancelledError() if job.cancelled() else job.exception()
+        lengths = job.result() if not error else None
+
+        offset = 0
+        for request_texts, future in batch:
+            if future.done():
+                # The caller was cancelled
+                pass
+            elif error:
+                future.set_exception(error)
+            else:
+                future.set_result(lengths[offset : offset + len(request_texts)])
+            offset += len(request_texts)
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+tokenizer = TokenizerService(cache_dir=bot_config.bot.tokenizer_cache_dir)
@@ -0,0 +1,144 @@
+from attrs import define, field
+from collections import OrderedDict
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# How many threads to keep usage totals for
+MAX_TRACKED_THREADS = 10000
+
+# Weight of the newest sample in the running estimate calibration
+CALIBRATION_WEIGHT = 0.2
+
+
+@define
+class RequestScope:
+    """Who a request is for. Used to take turns in the scheduler and to total usage."""
+
+    thread_id: Optional[int] = field(default=None)
+    guild_id: Optional[int] = field(default=None)
+
+    def log_context(self, model: str) -> dict:
+        """Fields for structured log records about this request."""
+        return {"thread_id": self.thread_id, "guild_id": self.guild_id, "model": model}
+
+
+@define
+class Usage:
+    requests: int = field(default=0)
+    prompt_tokens: int = field(default=0)
+    completion_tokens: int = field(default=0)
+    # Prompt tokens OpenAI served from its prompt cache
+    cached_tokens: int = field(default=0)
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int):
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+
+    @property
+    def cache_hit_rate(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def as_dict(self) -> dict[str, float | int]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_rate": self.cache_hit_rate,
+        }
+
+
+class UsageTracker:
+    """Token usage as reported by OpenAI, totalled per thread, guild and model.
+
+    The server's prompt counts are also compared with our local estimates to calibrate them.
+    """
+
+    by_thread: OrderedDict[int, Usage]
+    by_guild: dict[int, Usage]
+    by_model: dict[str, Usage]
+    # model -> running ratio of server prompt tokens to our estimate
+    calibration: dict[str, float]
+
+    def __init__(self):
+        self.by_thread = OrderedDict()
+        self.by_guild = {}
+        self.by_model = {}
+        self.calibration = {}
+
+    def record(
+        self,
+        model: str,
+        usage,
+        scope: Optional[RequestScope] = None,
+        estimated_prompt_tokens: Optional[int] = None,
+    ):
+        """Record the usage object from a completion."""
+        if not usage:
+            return
+
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (details.cached_tokens or 0) if details else 0
+        counts = (usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+
+        self.by_model.setdefault(model, Usage()).add(*counts)
+        if scope and scope.guild_id:
+            self.by_guild.setdefault(scope.guild_id, Usage()).add(*counts)
+        if scope and scope.thread_id:
+            self._thread_usage(scope.thread_id).add(*counts)
+
+        if estimated_prompt_tokens:
+            ratio = usage.prompt_tokens / estimated_prompt_tokens
+            previous = self.calibration.get(model, ratio)
+            self.calibration[model] = previous + CALIBRATION_WEIGHT * (ratio - previous)
+
+        logger.debug(
+            "OpenAI usage for %s: %d prompt (%d cached, estimated %s), %d completion",
+            model,
+            usage.prompt_tokens,
+            cached_tokens,
+            estimated_prompt_tokens,
+            usage.completion_tokens,
+        )
+
+    def _thread_usage(self, thread_id: int) -> Usage:
+        if thread_id in self.by_thread:
+            self.by_thread.move_to_end(thread_id)
+        else:
+            self.by_thread[thread_id] = Usage()
+            while len(self.by_thread) > MAX_TRACKED_THREADS:
+                self.by_thread.popitem(last=False)
+        return self.by_thread[thread_id]
+
+    def calibrated(self, model: str, estimated_tokens: int) -> int:
+        """Adjust a local token estimate by how far off our estimates have been for this model."""
+        return round(estimated_tokens * self.calibration.get(model, 1))
+
+    @property
+    def stats(self) -> dict[str, dict[str, float | int]]:
+        return {
+            model: {**usage.as_dict(), "calibration": self.calibration.get(model, 1)}
+            for model, usage in self.by_model.items()
+        }
+
+    @property
+    def guild_stats(self) -> dict[int, dict[str, float | int]]:
+        return {guild_id: usage.as_dict() for guild_id, usage in self.by_guild.items()}
+
+    def top_threads(self, count: int = 10) -> dict[int, dict[str, float | int]]:
+        """Usage for the threads that have used the most tokens."""
+        top = sorted(
+            self.by_thread.items(), key=lambda item: item[1].total_tokens, reverse=True
+        )
+        return {thread_id: usage.as_dict() for thread_id, usage in top[:count]}
+
+
+usage_tracker = UsageTracker()
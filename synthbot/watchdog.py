@@ -0,0 +1,126 @@
+import asyncio
+from collections import deque
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# How many recent lag samples to take percentiles over
+RECENT_SAMPLES = 1000
+
+loop_lag_seconds = metrics.histogram(
+    "synthbot_event_loop_lag_seconds",
+    "How late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+loop_stalls = metrics.counter(
+    "synthbot_event_loop_stalls_total",
+    "Times the event loop was blocked past the stall threshold",
+)
+
+
+class LoopWatchdog:
+    """Measures event loop lag, and logs what the loop was running when it gets stuck.
+
+    A timer on the loop records how late it wakes up. A separate thread watches for the timer not running at
+    all, and when it's been stuck past the threshold, logs the loop thread's stack and current task.
+    """
+
+    # Recent lag samples, newest last
+    recent: deque[float]
+
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        self._heartbeat = time.monotonic()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task[None]] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+        metrics.collect(
+            "synthbot_event_loop_lag_recent_seconds",
+            "Event loop lag percentiles over the most recent samples",
+            "gauge",
+            ("quantile",),
+            lambda: {
+                (str(quantile),): self.percentile(quantile * 100) or 0
+                for quantile in (0.5, 0.9, 0.99)
+            },
+        )
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    async def _measure(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+
+            lag = max(0, self._heartbeat - start - self.interval)
+            self.recent.append(lag)
+            loop_lag_seconds.observe(lag)
+            if lag > self.threshold:
+                logger.warning("Event loop was blocked for %.2fs", lag)
+
+    def _watch(self):
+        """Runs on the watchdog thread."""
+        reported = None
+        while not self._stop.wait(self.interval):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or heartbeat == reported:
+                continue
+
+            # Only report each stall once
+            reported = heartbeat
+            loop_stalls.inc()
+            self._report(stalled)
+
+    def _report(self, stalled: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(no stack)"
+
+        # Not thread safe, but it's only read, and only to say what was running
+        task = asyncio.current_task(self._loop)
+        running = (
+            f"{task.get_name()} {task.get_coro()!r}"
+            if task
+            else "(a callback, not a task)"
+        )
+
+        logger.warning(
+            "Event loop has been blocked for %.2fs, running %s\n%s",
+            stalled,
+            running,
+            stack,
+        )